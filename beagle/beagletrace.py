@@ -0,0 +1,331 @@
+'''
+Beagle USB analyser traces as a compact indexed binary file, and replay of those traces
+as a stand-in for the PyUSB device used by klarty.
+
+Beagle CSV exports (Total Phase Data Center) are read line by line, so memory use does not
+depend on the size of the export. Only the transactions klarty cares about are kept:
+control transfers (setup bytes plus data stage) and bulk OUT/IN transactions with data.
+
+Binary trace format (all little endian):
+    HEADER  b'KLTRACE1'
+    RECORD  <BBBHHHQI kind, bmRequestType, bRequest (or endpoint), wValue, wIndex, wLength,
+                      timestamp in ns, payload length ... followed by the payload bytes
+    INDEX   uint64 file offset of each record
+    FOOTER  <QQ index offset, number of records, then b'KLTRIDX1'
+
+Replay against klarty, e.g. to check our control sequence against the OEM software:
+    d = klarty()
+    d.dev = ReplayDevice(BeagleTrace.load('capture.csv'), strict=False)
+    ...klarty calls...
+    d.dev.print_report()
+'''
+
+import os
+import sys
+import mmap
+import ctypes
+import struct
+import optparse
+from array import array
+from collections import namedtuple
+
+VERBOSE = False
+
+HEADER_MAGIC = b'KLTRACE1'
+FOOTER_MAGIC = b'KLTRIDX1'
+RECORD_FMT = struct.Struct('<BBBHHHQI')
+FOOTER_FMT = struct.Struct('<QQ')
+
+KIND_CTRL = 0
+KIND_BULK_OUT = 1
+KIND_BULK_IN = 2
+KIND_NAMES = ['CTRL', 'BULK OUT', 'BULK IN']
+
+TraceRecord = namedtuple("TraceRecord", ["kind", "bmRequestType", "bRequest", "wValue", "wIndex", "wLength", "t_ns", "payload"])
+Mismatch = namedtuple("Mismatch", ["position", "reason", "expected", "actual"])
+
+
+class ReplayMismatch(Exception):
+    pass
+
+
+def timestamp_ns(ts:str) -> int:
+    """Convert Beagle 'm:s.ms.us' timestamp to ns"""
+    minutes, rest = ts.split(':')
+    s, ms, us = rest.split('.')
+    return ((int(minutes) * 60 + int(s)) * 1000000 + int(ms) * 1000 + int(us)) * 1000
+
+
+def parse_csv(fname, device=None):
+    """Generate TraceRecords from a Beagle CSV export, one line at a time
+
+    If device is given, only transactions with that USB device address are kept.
+    """
+    pending_data = b''
+    pending_ns = 0
+    with open(fname, 'r') as inf:
+        for line in inf:
+            if line.startswith('#'):
+                continue
+            cols = line.rstrip('\r\n').split(',', 10)
+            if len(cols) < 11 or cols[8] == '':
+                continue
+            if device is not None and cols[7] != device:
+                continue
+            level, ep, rec = cols[0], cols[8], cols[9].strip()
+            if ep == '00':
+                if level == '0' and rec == 'Control Transfer':
+                    pending_data = bytes.fromhex(cols[10])
+                    pending_ns = timestamp_ns(cols[3])
+                elif level == '1' and rec == 'SETUP txn':
+                    setup = bytes.fromhex(cols[10])
+                    bmRequestType, bRequest, wValue, wIndex, wLength = struct.unpack('<BBHHH', setup)
+                    yield TraceRecord(KIND_CTRL, bmRequestType, bRequest, wValue, wIndex, wLength, pending_ns, pending_data)
+                    pending_data = b''
+            elif level == '0' and '(NAK)' not in rec and cols[10]:
+                if rec.startswith('OUT txn'):
+                    kind, endpoint = KIND_BULK_OUT, int(ep, 16)
+                elif rec.startswith('IN txn'):
+                    kind, endpoint = KIND_BULK_IN, int(ep, 16) | 0x80
+                else:
+                    continue
+                payload = bytes.fromhex(cols[10])
+                yield TraceRecord(kind, 0, endpoint, 0, 0, len(payload), timestamp_ns(cols[3]), payload)
+
+
+def write_trace(fname, records):
+    """Write TraceRecords to a binary trace file, returns the number of records"""
+    index = array('Q')
+    with open(fname, 'wb') as outf:
+        outf.write(HEADER_MAGIC)
+        pos = len(HEADER_MAGIC)
+        for r in records:
+            index.append(pos)
+            outf.write(RECORD_FMT.pack(r.kind, r.bmRequestType, r.bRequest, r.wValue, r.wIndex, r.wLength, r.t_ns, len(r.payload)))
+            outf.write(r.payload)
+            pos += RECORD_FMT.size + len(r.payload)
+        if sys.byteorder != 'little':
+            index.byteswap()
+        index.tofile(outf)
+        outf.write(FOOTER_FMT.pack(pos, len(index)))
+        outf.write(FOOTER_MAGIC)
+    return len(index)
+
+
+def csv_to_trace(csv_fname, trace_fname, device=None):
+    if VERBOSE: print('Reading from {0}'.format(csv_fname))
+    n = write_trace(trace_fname, parse_csv(csv_fname, device))
+    if VERBOSE: print('  {0} records written to {1}'.format(n, trace_fname))
+    return n
+
+
+class BeagleTrace:
+    """Read only, memory mapped view of a binary trace file"""
+
+    def __init__(self, fname):
+        self._f = open(fname, 'rb')
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(HEADER_MAGIC)] != HEADER_MAGIC or self._mm[-len(FOOTER_MAGIC):] != FOOTER_MAGIC:
+            raise ValueError('Not a klarty binary trace file')
+        footer_pos = len(self._mm) - len(FOOTER_MAGIC) - FOOTER_FMT.size
+        index_pos, n_records = FOOTER_FMT.unpack_from(self._mm, footer_pos)
+        self._index = array('Q', self._mm[index_pos:index_pos + 8 * n_records])
+        if sys.byteorder != 'little':
+            self._index.byteswap()
+
+
+    @classmethod
+    def load(cls, fname, device=None):
+        """Open a trace, converting from Beagle CSV first if required
+
+        The converted trace is cached alongside the CSV with a .ktrace extension, or
+        .devN.ktrace when only device N is kept, and is rebuilt if the CSV is newer.
+        """
+        if not fname.lower().endswith('.csv'):
+            return cls(fname)
+        trace_fname = os.path.splitext(fname)[0] + ('.ktrace' if device is None else f'.dev{device}.ktrace')
+        if not os.path.isfile(trace_fname) or os.path.getmtime(trace_fname) < os.path.getmtime(fname):
+            csv_to_trace(fname, trace_fname, device)
+        return cls(trace_fname)
+
+
+    def close(self):
+        self._index = array('Q')
+        self._mm.close()
+        self._f.close()
+
+
+    def __len__(self):
+        return len(self._index)
+
+
+    def __getitem__(self, i) -> TraceRecord:
+        pos = self._index[i]
+        fields = RECORD_FMT.unpack_from(self._mm, pos)
+        start = pos + RECORD_FMT.size
+        return TraceRecord(*fields[:7], self._mm[start:start + fields[7]])
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+    def bulk_data(self, endpoint) -> bytes:
+        """All payload bytes for one bulk endpoint, e.g. 0x02 for the FPGA bitstream"""
+        return b''.join(r.payload for r in self if r.kind != KIND_CTRL and r.bRequest == endpoint)
+
+
+def format_record(r:TraceRecord) -> str:
+    if r.kind == KIND_CTRL:
+        return "{:8} {:02X} {:02X} wValue:{:04X} wIndex:{:04X} wLength:{:3d} [{}]".format(
+            KIND_NAMES[r.kind], r.bmRequestType, r.bRequest, r.wValue, r.wIndex, r.wLength, bytes(r.payload).hex(' ').upper())
+    return "{:8} EP{:02X} {:5d} bytes".format(KIND_NAMES[r.kind], r.bRequest, len(r.payload))
+
+
+class ReplayDevice:
+    """Stands in for a PyUSB device, checking each transaction against a trace
+
+    IN transfers return the recorded data. With strict=True the first mismatch raises
+    ReplayMismatch. Otherwise mismatches are collected in self.mismatches: transactions
+    we issue that are not next in the trace are reported as 'unexpected' (IN transfers
+    get zeros) and trace records skipped over to resynchronise are reported as 'skipped'.
+    Control transfer wValue bits in wValue_ignore are not compared, e.g. 0x80 for the read
+    flag klarty sets on FPGA register reads, where KingstVIS leaves it clear.
+    """
+
+    def __init__(self, trace:BeagleTrace, strict:bool=True, lookahead:int=64, wValue_ignore:int=0):
+        self.trace = trace
+        self.strict = strict
+        self.lookahead = lookahead
+        self.wValue_mask = ~wValue_ignore
+        self.pos = 0
+        self.mismatches = []
+
+
+    def set_configuration(self, configuration=None):
+        pass
+
+
+    def _mismatch(self, reason, expected, actual):
+        m = Mismatch(self.pos, reason, expected, actual)
+        if self.strict:
+            raise ReplayMismatch('Trace record {}: {}\n  expected {}\n  actual   {}'.format(m.position, reason, expected, actual))
+        self.mismatches.append(m)
+
+
+    def _find(self, matches):
+        """Position of the next trace record satisfying matches(), within lookahead"""
+        end = min(len(self.trace), self.pos + (1 if self.strict else self.lookahead))
+        for i in range(self.pos, end):
+            if matches(self.trace[i]):
+                return i
+        return None
+
+
+    def _consume(self, i):
+        for j in range(self.pos, i):
+            skipped = self.trace[j]
+            self.pos = j
+            self._mismatch('skipped', format_record(skipped), None)
+        self.pos = i + 1
+
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        is_in = bool(bmRequestType & 0x80)
+        if is_in:
+            wLength = data_or_wLength
+            data = b''
+        else:
+            data = bytes(data_or_wLength) if data_or_wLength is not None else b''
+            wLength = len(data)
+        actual = TraceRecord(KIND_CTRL, bmRequestType, bRequest, wValue, wIndex, wLength, 0, data)
+
+        def matches(r):
+            return (r.kind == KIND_CTRL and r.bmRequestType == bmRequestType and r.bRequest == bRequest
+                    and r.wValue & self.wValue_mask == wValue & self.wValue_mask and r.wIndex == wIndex and r.wLength == wLength
+                    and (is_in or r.payload == data))
+
+        i = self._find(matches)
+        if i is None:
+            expected = format_record(self.trace[self.pos]) if self.pos < len(self.trace) else 'end of trace'
+            self._mismatch('unexpected', expected, format_record(actual))
+            return array('B', bytes(wLength)) if is_in else wLength
+        self._consume(i)
+        if is_in:
+            return array('B', self.trace[i].payload)
+        return wLength
+
+
+    def _bulk(self, kind, endpoint, n_bytes, data=None):
+        """Gather consecutive bulk records on endpoint up to n_bytes, returns their payload"""
+        i = self._find(lambda r: r.kind == kind and r.bRequest == endpoint)
+        if i is None:
+            expected = format_record(self.trace[self.pos]) if self.pos < len(self.trace) else 'end of trace'
+            self._mismatch('unexpected', expected, '{:8} EP{:02X} {:5d} bytes'.format(KIND_NAMES[kind], endpoint, n_bytes))
+            return None
+        self._consume(i)
+        chunks = [self.trace[i].payload]
+        n = len(chunks[0])
+        while n < n_bytes and self.pos < len(self.trace):
+            r = self.trace[self.pos]
+            if r.kind != kind or r.bRequest != endpoint:
+                break
+            chunks.append(r.payload)
+            n += len(r.payload)
+            self.pos += 1
+        return b''.join(chunks)
+
+
+    def write(self, endpoint, data, timeout=None):
+        data = bytes(data)
+        recorded = self._bulk(KIND_BULK_OUT, endpoint, len(data))
+        if recorded is not None and recorded != data:
+            self._mismatch('bulk data differs', '{} bytes'.format(len(recorded)), '{} bytes'.format(len(data)))
+        return len(data)
+
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        # Buffers are array.array, possibly klarty.ReadBuffer standing in for another buffer, so
+        # the memory is found with buffer_info() as the PyUSB backends do
+        if isinstance(size_or_buffer, int):
+            n_bytes = size_or_buffer
+        else:
+            address, n_items = size_or_buffer.buffer_info()
+            n_bytes = n_items * size_or_buffer.itemsize
+        recorded = self._bulk(KIND_BULK_IN, endpoint, n_bytes) or b''
+        recorded = recorded[:n_bytes]
+        if isinstance(size_or_buffer, int):
+            return array('B', recorded)
+        ctypes.memmove(address, recorded, len(recorded))
+        return len(recorded)
+
+
+    def print_report(self):
+        print('Replayed {} of {} trace records, {} mismatches'.format(self.pos, len(self.trace), len(self.mismatches)))
+        for m in self.mismatches:
+            print('  {:6d} {:10} expected: {}'.format(m.position, m.reason, m.expected))
+            if m.actual:
+                print('  {:6} {:10}   actual: {}'.format('', '', m.actual))
+
+
+def main(input, output, list_records):
+    if output:
+        csv_to_trace(input, output)
+        trace = BeagleTrace(output)
+    else:
+        trace = BeagleTrace.load(input)
+    if VERBOSE: print('{0} records'.format(len(trace)))
+    if list_records:
+        for r in trace:
+            print('{:14.6f}s {}'.format(r.t_ns / 1e9, format_record(r)))
+
+if __name__=="__main__":
+    parser = optparse.OptionParser()
+    parser.add_option('-i', '--input',   dest='input',   help='name of Beagle CSV (or binary trace) input file')
+    parser.add_option('-o', '--output',  dest='output',  help='name of binary trace output file (default: input with .ktrace extension)')
+    parser.add_option('-l', '--list',    dest='list',    help='list the trace records', action='store_true', default=False)
+    parser.add_option('-v', '--verbose', dest='verbose', help='output extra status information', action='store_true', default=False)
+    (options, args) = parser.parse_args()
+    VERBOSE = options.verbose
+    main(options.input, options.output, options.list)
@@ -0,0 +1,69 @@
+'''
+Benchmark csv2streams.ingest() against the line by line csv2bin.read_hexfile().
+
+A large export is made by repeating the body of one of the Beagle CSVs in this
+directory, then both are timed extracting the EP2 (FPGA bitstream) bytes and
+the outputs are checked to be identical.
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import optparse
+
+import csv2bin
+import csv2streams
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CSV = os.path.join(HERE, 'KingstVIS 3.4.3', 'AppStart-StreaminMode-NormalMode-XL.csv')
+
+
+def make_scaled_csv(src, dst, scale):
+    with open(src, 'rb') as inf:
+        lines = inf.readlines()
+    header = [l for l in lines if l.startswith(b'#')]
+    body = b''.join(l for l in lines if not l.startswith(b'#'))
+    with open(dst, 'wb') as outf:
+        outf.writelines(header)
+        for _ in range(scale):
+            outf.write(body)
+
+
+def main(input, scale):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        csv_fname = os.path.join(tmpdir, 'scaled.csv')
+        make_scaled_csv(input, csv_fname, scale)
+        csv_sz = os.stat(csv_fname).st_size
+        print('{0} x{1} = {2:.1f}MB'.format(os.path.basename(input), scale, csv_sz / 1e6))
+
+        t = time.perf_counter()
+        old = bytes(csv2bin.read_hexfile(csv_fname))
+        t_old = time.perf_counter() - t
+        print('csv2bin.read_hexfile  {0:8.3f}s {1:8.1f}MB/s  {2} EP2 bytes'.format(t_old, csv_sz / 1e6 / t_old, len(old)))
+
+        prefix = os.path.join(tmpdir, 'scaled')
+        t = time.perf_counter()
+        csv2streams.ingest(csv_fname, prefix, endpoints={0x02}, control=False)
+        t_new = time.perf_counter() - t
+        with open(prefix + '-ep02.bin', 'rb') as f:
+            new = f.read()
+        print('csv2streams.ingest    {0:8.3f}s {1:8.1f}MB/s  {2} EP2 bytes'.format(t_new, csv_sz / 1e6 / t_new, len(new)))
+
+        t = time.perf_counter()
+        totals = csv2streams.ingest(csv_fname, prefix)
+        t_all = time.perf_counter() - t
+        print('  all endpoints+ctrl  {0:8.3f}s {1:8.1f}MB/s  {2}'.format(t_all, csv_sz / 1e6 / t_all,
+              ', '.join('{0}={1}'.format(k if k == 'ctrl' else 'ep{:02x}'.format(k), v) for k, v in totals.items())))
+
+        print('Speed up x{0:.1f}, outputs {1}'.format(t_old / t_new, 'identical' if old == new else '**DIFFER**'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__=="__main__":
+    parser = optparse.OptionParser()
+    parser.add_option('-i', '--input', dest='input', help='name of Beagle CSV file to scale up', default=DEFAULT_CSV)
+    parser.add_option('-s', '--scale', dest='scale', help='number of copies of the CSV body', type='int', default=50)
+    (options, args) = parser.parse_args()
+    main(options.input, options.scale)
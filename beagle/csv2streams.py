@@ -0,0 +1,139 @@
+'''
+High throughput conversion of Beagle CSV exports into binary payload streams.
+
+The CSV is read in large blocks and only rows for the wanted endpoints and
+transaction types are split. Hex payloads are gathered per endpoint for the
+whole block and converted with a single bytes.fromhex() call.
+
+Outputs, for output prefix PREFIX:
+    PREFIX-ep02.bin     Bulk payload bytes for each endpoint (IN endpoints as ep86 etc.)
+    PREFIX-ctrl.idx     Control transfer index, one CTRL_INDEX_FMT record per transfer:
+                        timestamp ns, 8 setup bytes, offset and length of data in PREFIX-ctrl.bin
+    PREFIX-ctrl.bin     Control transfer data stage bytes
+
+See bench-csv2streams.py for a comparison with csv2bin.py.
+'''
+
+import os
+import struct
+import optparse
+
+from beagletrace import timestamp_ns
+
+VERBOSE = False
+
+BLOCK_SIZE = 16 * 1024 * 1024
+CTRL_INDEX_FMT = struct.Struct('<Q8sQI')
+
+
+def read_blocks(fname, block_size=BLOCK_SIZE):
+    """Generate lists of complete CSV lines, reading block_size bytes at a time"""
+    tail = ''
+    with open(fname, 'rb') as inf:
+        while True:
+            block = inf.read(block_size)
+            if not block:
+                break
+            lines = (tail + block.decode('ascii', 'replace')).split('\n')
+            tail = lines.pop()
+            yield lines
+    if tail:
+        yield [tail]
+
+
+def ingest(fname, out_prefix, endpoints=None, control=True, block_size=BLOCK_SIZE):
+    """Convert a Beagle CSV export to payload streams, returns bytes written per stream
+
+    endpoints is a collection of endpoint numbers to keep, IN endpoints with bit 7 set
+    (e.g. 0x02, 0x86). All bulk endpoints are kept if it is None.
+    control selects whether the control transfer index is written.
+    """
+    outputs = {}
+    totals = {}
+    pending_data = ''
+    pending_ns = 0
+    ctrl_data_pos = 0
+    ctrl_idx = open(out_prefix + '-ctrl.idx', 'wb') if control else None
+    ctrl_bin = open(out_prefix + '-ctrl.bin', 'wb') if control else None
+    try:
+        for lines in read_blocks(fname, block_size):
+            payloads = {}
+            for line in lines:
+                # Level 0 rows hold bulk transactions and control transfer data, SETUP txns are level 1
+                if line[:2] == '0,':
+                    cols = line.split(',', 10)
+                    if len(cols) < 11:
+                        continue
+                    ep = cols[8]
+                    if ep == '00':
+                        if control and cols[9] == 'Control Transfer':
+                            pending_data = cols[10]
+                            pending_ns = timestamp_ns(cols[3])
+                        continue
+                    if not ep or '(NAK)' in cols[9]:
+                        continue
+                    if cols[9].startswith('OUT txn'):
+                        endpoint = int(ep, 16)
+                    elif cols[9].startswith('IN txn'):
+                        endpoint = int(ep, 16) | 0x80
+                    else:
+                        continue
+                    if endpoints is None or endpoint in endpoints:
+                        payloads.setdefault(endpoint, []).append(cols[10])
+                elif control and line[:2] == '1,' and 'SETUP txn' in line:
+                    cols = line.split(',', 10)
+                    if len(cols) < 11 or cols[8] != '00':
+                        continue
+                    data = bytes.fromhex(pending_data)
+                    ctrl_idx.write(CTRL_INDEX_FMT.pack(pending_ns, bytes.fromhex(cols[10]), ctrl_data_pos, len(data)))
+                    ctrl_bin.write(data)
+                    ctrl_data_pos += len(data)
+                    pending_data = ''
+            for endpoint, hex_strings in payloads.items():
+                if endpoint not in outputs:
+                    outputs[endpoint] = open('{}-ep{:02x}.bin'.format(out_prefix, endpoint), 'wb')
+                    totals[endpoint] = 0
+                data = bytes.fromhex(' '.join(hex_strings))
+                outputs[endpoint].write(data)
+                totals[endpoint] += len(data)
+    finally:
+        for f in outputs.values():
+            f.close()
+        if control:
+            ctrl_idx.close()
+            ctrl_bin.close()
+    if control:
+        totals['ctrl'] = ctrl_data_pos
+    return totals
+
+
+def read_ctrl_index(out_prefix):
+    """Generate (t_ns, setup, data) for each control transfer written by ingest()"""
+    with open(out_prefix + '-ctrl.idx', 'rb') as idx, open(out_prefix + '-ctrl.bin', 'rb') as data:
+        ctrl_data = data.read()
+        for t_ns, setup, pos, n in CTRL_INDEX_FMT.iter_unpack(idx.read()):
+            yield t_ns, setup, ctrl_data[pos:pos + n]
+
+
+def main(input, output, endpoints, control):
+    if VERBOSE: print('Reading from {0}'.format(input))
+    if output is None:
+        output = os.path.splitext(input)[0]
+    if endpoints:
+        endpoints = set(int(ep, 16) for ep in endpoints.split(','))
+    totals = ingest(input, output, endpoints, control)
+    if VERBOSE:
+        for stream, n in totals.items():
+            name = 'ctrl' if stream == 'ctrl' else 'ep{:02x}'.format(stream)
+            print('  {0}-{1}: {2} bytes written'.format(output, name, n))
+
+if __name__=="__main__":
+    parser = optparse.OptionParser()
+    parser.add_option('-i', '--input',     dest='input',     help='name of Beagle CSV input file')
+    parser.add_option('-o', '--output',    dest='output',    help='output file prefix (default: input without extension)')
+    parser.add_option('-e', '--endpoints', dest='endpoints', help='comma separated hex endpoints to keep, e.g. 02,86 (default: all)')
+    parser.add_option('-n', '--no-control', dest='control',  help='do not write the control transfer index', action='store_false', default=True)
+    parser.add_option('-v', '--verbose',   dest='verbose',   help='output extra status information', action='store_true', default=False)
+    (options, args) = parser.parse_args()
+    VERBOSE = options.verbose
+    main(options.input, options.output, options.endpoints, options.control)
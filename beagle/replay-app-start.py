@@ -0,0 +1,86 @@
+'''
+Replay the OEM software start-up trace against klarty and report where our USB
+control sequence differs from KingstVIS, including a normal mode capture and its upload.
+
+The known differences are listed in EXPECTED_MISMATCHES, by trace record. The exit
+status is non-zero if there are any others.
+'''
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from klarty import klarty, FPGA_REG_RUN, VENDOR_CTRL_OUT, FX2CMD_START_BULK_TRANSFER_x30_d48
+from beagletrace import BeagleTrace, ReplayDevice
+
+# Trace record: why klarty differs there from KingstVIS. FPGA register reads also differ, klarty
+# sets the read flag 0x80 in wValue, so ReplayDevice ignores that bit.
+EXPECTED_MISMATCHES = {
+    2:   'klarty holds the FPGA in reset before loading the bitstream',
+    366: 'the KAuth challenge is random',
+    367: 'the KAuth challenge is random',
+    370: 'the KAuth challenge is random',
+    372: 'R56 duty for 1.65V from THRESHOLD_LINES, KingstVIS uses 0x26D',
+    379: 'KingstVIS reserves pre-trigger memory with 0% pre-trigger',
+    513: 'KingstVIS clears the EP86 halt after reading stream mode data',
+    516: 'KingstVIS reserves pre-trigger memory with 0% pre-trigger',
+    530: 'KingstVIS clears the EP86 halt after the upload, klarty stops the acquisition',
+}
+
+trace_fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'KingstVIS 3.4.3', 'AppStart-StreaminMode-NormalMode-XL.csv')
+trace = BeagleTrace.load(trace_fname)
+
+# The FPGA bitstream is sent on EP2, so the trace holds its own copy
+bitstream_fd, bitstream_fname = tempfile.mkstemp(suffix='.bitstream')
+with os.fdopen(bitstream_fd, 'wb') as f:
+    f.write(trace.bulk_data(0x02))
+
+d = klarty()
+d.dev = ReplayDevice(trace, strict=False, wValue_ignore=0x80) # klarty sets the FPGA read flag, KingstVIS doesn't
+d.capture_data_to_file = lambda data: None # Don't save the replayed upload
+try:
+    d.eeprom_read(0x20, 4)
+    d.set_model_identity()
+    d.load_fpga_fw(bitstream_fname)
+    d.get_run_state()
+    d.kauth_authenticate()
+    d.get_run_state()
+    d.kauth_read_serial()
+    d.reset_bulk()
+    d.threshold(1.65)
+    d.user_pwm_enable(0,0)
+    d.user_pwm_settings(1, 1e3, 50)
+    d.user_pwm_settings(2, 100e3, 50)
+    d.user_pwm_enable(1,1)
+
+    # KingstVIS briefly starts a stream mode capture
+    d.fpga_write(FPGA_REG_RUN + 3, bytes([1]))
+    d.set_trigger_config(verbose=False)
+    d.set_sample_config(1e5, 20000, 0)
+    d.reset_bulk()
+    d.start_acquisition()
+    d.dev.ctrl_transfer(VENDOR_CTRL_OUT, FX2CMD_START_BULK_TRANSFER_x30_d48, 0, 0, None, 100)
+    d.dev.read(0x86, 1024*1024) # Stream mode data, as much as KingstVIS read
+    d.fpga_write(FPGA_REG_RUN, bytes([0]))
+
+    # Then a normal mode capture, as klarty-03-capture-now.py
+    d.stop_sampling()
+    d.set_trigger_config(verbose=False)
+    d.set_sample_config(1e5, 20000, 0)
+    d.start_acquisition()
+    for _ in range(5):
+        if d.get_run_state() & 0x000F == 0x000D:
+            break
+    ci = d.capture_info()
+    d.capture_upload(ci.n_rep_packets, ci.write_pos, ci.n_rep_packets_before_trigger)
+    d.stop_acquisition()
+finally:
+    d.dev.print_report()
+    unexpected = [m for m in d.dev.mismatches if m.position not in EXPECTED_MISMATCHES]
+    d.dev = None
+    trace.close()
+    os.remove(bitstream_fname)
+
+print('{} upload bytes replayed, {} unexpected mismatches'.format(d.metrics.get('upload_bytes', 0), len(unexpected)))
+sys.exit(1 if unexpected or not d.metrics.get('upload_bytes') else 0)
@@ -1,4 +1,6 @@
-from klarty import klarty
+from klarty import klarty, console_logging
+
+console_logging()
 
 d = klarty()
 d.connect()
@@ -1,4 +1,7 @@
-from klarty import klarty, LA_models
+from klarty import klarty, LA_models, console_logging
+from klarty_threshold import apply_calibration
+
+console_logging()
 
 d = klarty()
 d.connect()
@@ -37,6 +40,8 @@ d.print_ascii_hex(d.eeprom_read(0x08,8))
 
 print('KAuth serial response:')
 d.kauth_read_serial()
+if apply_calibration(d): # Now the serial is known
+    print(f'Threshold {d.threshold_volts}V set with the saved calibration, see klarty_threshold.py')
 print('KAuth challenge response:')
 d.kauth_authenticate()
 
@@ -1,4 +1,4 @@
-from klarty import klarty
+from klarty import klarty, console_logging
 from datetime import datetime
 import time
 
@@ -6,11 +6,15 @@ sample_rate = 1e5
 sample_count = 5e5
 pre_trigger_percent = 40
 
+console_logging()
+
 d = klarty()
 d.connect()
 
 d.set_model_identity() # Set FPGA clock rate for capture calculations
 
+d.log_capture_plan(d.plan_capture(sample_rate,sample_count,pre_trigger_percent))
+
 d.stop_sampling() # FPGAreg3 = 0x00
 
 d.set_trigger_config() #verbose=False)
@@ -55,4 +59,4 @@ d.stop_acquisition()  # FPGAreg1 = 0x01, FPGAreg0 = 0x00
 
 ci = d.capture_info()
 
-d.capture_upload(ci.n_rep_packets, ci.write_pos)
+d.capture_upload(ci.n_rep_packets, ci.write_pos, ci.n_rep_packets_before_trigger)
@@ -0,0 +1,14 @@
+from klarty_capture import read_capture_file
+from klarty_measure import measure, print_measurements
+import glob
+import os
+
+sample_rate = 1e5  # As used for the capture, it is not saved in the file
+channels = range(16)
+window = None      # (t_start, t_end) in seconds from the trigger, or None for the whole capture
+
+capture_file = max(glob.glob('captures/*.bin'), key=os.path.getmtime)
+cap = read_capture_file(capture_file, sample_rate)
+print(f'{capture_file}: {cap.n_samples} samples in {len(cap)} runs at {sample_rate:g}Hz')
+
+print_measurements([m for m in measure(cap, channels, window) if m.n_rising + m.n_falling])
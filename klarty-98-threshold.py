@@ -1,4 +1,4 @@
-from klarty import klarty
+from klarty import klarty, console_logging
 
 '''
 These are the values OEM software writes to FPGA
@@ -47,6 +47,8 @@ Custom    -4V0       1.825     FF87 02D7   Unintended rollover in Kingst softwar
 So, the above data is fitted with three seperate straight line fits
 '''
 
+console_logging()
+
 dev = klarty()
 dev.connect()
 dev.threshold(1.65)
@@ -15,16 +15,28 @@ You should have received a copy of the GNU General Public License
 along with this program; if not, see <http://www.gnu.org/licenses/>.
 '''
 
-import zlib, struct, time, os, math
+import zlib, struct, time, os, math, array, ctypes, logging
 from datetime import datetime
 from collections import namedtuple
 from enum import Enum
-try:
-    import usb.core,usb.util
-except ImportError as e:
-    print("The pyusb module needs to be installed.\n"
-          "At command prompt type:\npy -m pip install pyusb\n"
-          "Also, the libusb library needs to be on the system path")
+
+from klarty_format import (SAMPLE_MEM_SZ_BYTES, SIZEOF_REP_PKT, N_REP_PKTS_PER_TRANSFER_PKT, SIZEOF_TRANSFER_PKT,
+                           MAX_REP_COUNT, MAX_REP_PKTS_IN_MEM, rep_packets_to_nbytes, rep_packet_offset)
+
+usb = None # PyUSB, imported by import_usb() when a device is first needed so analysis code runs without it
+
+
+def import_usb():
+    global usb
+    if usb is None:
+        try:
+            import usb.core,usb.util
+        except ImportError as e:
+            print("The pyusb module needs to be installed.\n"
+                  "At command prompt type:\npy -m pip install pyusb\n"
+                  "Also, the libusb library needs to be on the system path")
+            raise
+    return usb
 
 
 # Windows:
@@ -75,6 +87,34 @@ except ImportError as e:
 # During upload of large captures (tens of megabytes) quite a lot of bytes go missing. Probably
 # need to use pre-allocated receive buffer in capture_upload_nbytes()
 
+# Logging:
+
+# Reporting goes through the 'klarty' loggers below rather than print(), so nothing is formatted
+# unless a handler wants the record. Call console_logging() to see messages on the console.
+# Numbers of interest to automation are also kept in klarty.metrics, see capture_upload_nbytes().
+
+log_fw = logging.getLogger('klarty.fw')            # FX2 firmware and FPGA bitstream loading
+log_dev = logging.getLogger('klarty.device')       # Model identity, EEPROM and KAuth chip
+log_fpga = logging.getLogger('klarty.fpga')        # User PWM, threshold, sample and trigger configuration
+log_capture = logging.getLogger('klarty.capture')  # Capture info, planning, upload and saving
+
+
+class HexBytes:
+    """Bytes which are only formatted as hex if a log record is emitted"""
+    __slots__ = ('data',)
+
+    def __init__(self, data:bytes):
+        self.data = data
+
+    def __str__(self):
+        return ''.join('{:02X} '.format(b) for b in self.data)
+
+
+def console_logging(level=logging.INFO):
+    """Show klarty log messages on the console, much as they were printed before"""
+    logging.basicConfig(format='%(message)s', level=level)
+
+
 LAx016_VID = 0x77a1
 LAx016_PID = 0x01a2
 
@@ -114,6 +154,56 @@ FPGA_REG_PWM_EN     = 0x02 # Write reg, one byte, lower two bits enable/disable
 FPGA_REG_PWM1       = 0x70 # Write regs USER PWM1 0x70..0x73 32bit period register, 0x74..0x77 32bit duty register. 200MHz PWM clock.
 FPGA_REG_PWM2       = 0x78 # Write regs USER PWM2 0x78..0x7B 32bit period register, 0x7C..0x7F 32bit duty register. 200MHz PWM clock.
 
+DEFAULT_UPLOAD_BYTES_PER_SEC = 30e6 # Typical FX2 bulk throughput, replaced by the measured value after each upload
+
+CaptureInfo = namedtuple("CaptureInfo", ["n_rep_packets", "n_rep_packets_before_trigger", "write_pos"])
+CapturePlan = namedtuple("CapturePlan", ["sample_rate", "sample_clock_divisor", "n_samples", "pre_trigger_samples",
+                                         "capture_time", "min_rep_packets", "max_rep_packets", "min_bytes", "max_bytes",
+                                         "pre_trigger_mem_bytes", "max_pre_trigger_bytes", "min_upload_time", "max_upload_time"])
+UploadSpan = namedtuple("UploadSpan", ["start_pos", "n_bytes", "trigger_offset"])
+
+
+# R56 duty = slope * volts + offset as (slope, offset) for each of the three R79 duties threshold() uses,
+# fitted to the OEM software's settings in klarty-98-threshold.py. klarty_threshold.py measures them per analyser.
+THRESHOLD_LINES = {0x0000: (302, -363), 0x00F2: (302, 121), 0x02D7: (302, 1090)}
+THRESHOLD_DUTY_R56_MIN = 10
+THRESHOLD_DUTY_R56_MAX = 1100
+
+# Lower 4 bits of the FPGA run state, see get_run_state()
+RUN_STATE_NAMES = {0x2: 'Pre-sampling', 0xA: 'Waiting for trigger', 0xE: 'Running', 0xD: 'COMPLETE'}
+RUN_STATE_COMPLETE = 0xD
+
+
+class ReadBuffer(array.array):
+    """Lets PyUSB bulk reads go straight into any writable buffer, e.g. shared memory
+
+    Device.read() only reads into array.array objects and the backends only use buffer_info()
+    to find the memory, so this empty array gives them the address of the other buffer.
+    Use as a context manager, the buffer can't be resized or closed until it is released.
+    """
+
+    def __new__(cls, buffer, n_bytes:int=None):
+        self = super().__new__(cls, 'B')
+        self._target = (ctypes.c_ubyte * (len(buffer) if n_bytes is None else n_bytes)).from_buffer(buffer)
+        return self
+
+    def buffer_info(self):
+        return ctypes.addressof(self._target), len(self._target)
+
+    def release(self):
+        self._target = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def find_devices() -> list:
+    """All connected LA1016/LA2016 analysers, for use with klarty.connect()"""
+    return list(import_usb().core.find(find_all=True, idVendor=LAx016_VID, idProduct=LAx016_PID))
+
 
 class Chunker:
     """ A naive iterable chunker, probably slow and inefficient
@@ -179,6 +269,15 @@ class klarty:
         self.dev = None
         self.model = LA_models.LA2016_R2
         self.fpga_clk = 200e6
+        self.upload_bytes_per_sec = DEFAULT_UPLOAD_BYTES_PER_SEC
+        self.trace = None
+        self.metrics = {}
+        self.unit_type = None
+        self.serial = None
+        self.threshold_volts = None
+        self.threshold_lines = THRESHOLD_LINES # Replaced by calibrated lines, see klarty_threshold.py
+        self.catalog = None # e.g. klarty_catalog.Catalog(), records every capture saved
+        self._t_acquisition_start = None
     
 
     def __del__(self):
@@ -197,18 +296,42 @@ class klarty:
                 yield val
 
 
-    def connect(self):
-        self.dev = usb.core.find(idVendor=LAx016_VID, idProduct=LAx016_PID)
+    def connect(self, dev=None):
+        """Connect to the first analyser found, or to dev from find_devices()"""
+        self.dev = dev if dev is not None else import_usb().core.find(idVendor=LAx016_VID, idProduct=LAx016_PID)
         if self.dev is None:
             raise ValueError('Device not found')
         self.dev.set_configuration()
 
 
     def disconnect(self):
-        if self.dev != None:
+        self.disable_trace()
+        if usb is not None and isinstance(self.dev, usb.core.Device): # Not for simulated devices, see klarty_sim.py
             usb.util.dispose_resources(self.dev)
 
 
+    def enable_trace(self, n_records:int=65536):
+        """Record timing, size and meaning of every USB transaction with the device
+
+        See klarty_trace.py. The trace is a ring buffer holding the last n_records
+        transactions, it stays available in self.trace after disable_trace().
+        """
+
+        from klarty_trace import UsbTrace, TracedDevice
+        if self.dev is None:
+            raise ValueError('Device not connected')
+        if not isinstance(self.dev, TracedDevice):
+            self.trace = UsbTrace(n_records)
+            self.dev = TracedDevice(self.dev, self.trace)
+        return self.trace
+
+
+    def disable_trace(self):
+        """Stop recording USB transactions, the device is then used directly again"""
+        if self.trace is not None and getattr(self.dev, 'trace', None) is self.trace:
+            self.dev = self.dev.dev
+
+
     def load_fx2_fw(self, filename:str, apply_fw_patch:bool=False):
         """Load 8051 binary firmware file into the FX2"""
 
@@ -222,7 +345,7 @@ class klarty:
                 raise ValueError('Firmware file not found')
 
         fw_file_sz = os.stat(fw_filename).st_size
-        print(f"Loading FX2 firmware file '{fw_filename}' ({fw_file_sz} bytes)")
+        log_fw.info("Loading FX2 firmware file '%s' (%d bytes)", fw_filename, fw_file_sz)
         if fw_file_sz < 1000 or fw_file_sz > 20000:
             raise ValueError("Firmware file size doesn't seem correct")
 
@@ -230,22 +353,22 @@ class klarty:
             fw_bin = bytearray(fw.read()) # Read in whole file
 
         fw_crc = zlib.crc32(fw_bin) & 0xffffffff
-        print(f'Firmware CRC: 0x{fw_crc:08X}')
+        log_fw.info('Firmware CRC: 0x%08X', fw_crc, extra={'fw_crc': fw_crc})
 
         if fw_crc == 0x720551a9:
-            print('This is recognised as the FX2 firmware extracted from KingstVIS-Linux v3.4.2 (and perhaps other versions too)')
-            print('This version can be optionally patched to disable the FPGA bitstream\nlength check (which uses obfuscated length for some interlock scheme)')
-            print("If you know the bitstream 'obfuscated length' value for use with FX2CMD_FPGA_PROG_x50_d80, you don't need to patch:")
+            log_fw.info('This is recognised as the FX2 firmware extracted from KingstVIS-Linux v3.4.2 (and perhaps other versions too)')
+            log_fw.info('This version can be optionally patched to disable the FPGA bitstream\nlength check (which uses obfuscated length for some interlock scheme)')
+            log_fw.info("If you know the bitstream 'obfuscated length' value for use with FX2CMD_FPGA_PROG_x50_d80, you don't need to patch:")
             if apply_fw_patch:
-                print('\tPatch APPLIED')
+                log_fw.info('\tPatch APPLIED')
                 fw_bin[0xe30]= 0x02  # Jump over some code
                 fw_bin[0xe31]= 0x0e
                 fw_bin[0xe32]= 0x81
             else:
-                print('\tPatch NOT applied')
+                log_fw.info('\tPatch NOT applied')
         else:
-            print('This FX2 firmware is not recognised, it may work but has not been tested on LA1016\\LA2016')
-            print('Be aware this firmware probably uses an obfuscated length check on the FPGA bitstream to spoil your fun')
+            log_fw.warning('This FX2 firmware is not recognised, it may work but has not been tested on LA1016\\LA2016')
+            log_fw.warning('Be aware this firmware probably uses an obfuscated length check on the FPGA bitstream to spoil your fun')
 
         self.dev.ctrl_transfer(VENDOR_CTRL_OUT, 0xA0, 0xE600, 0, bytes([1]), 100) # FX2 RESET
         fw_chunks = Chunker(fw_bin,1024) # Read firmware in chunks of 1024 bytes, no padding at the end
@@ -254,7 +377,7 @@ class klarty:
             self.dev.ctrl_transfer(VENDOR_CTRL_OUT, 0xA0, offset, 0, chunk, 100)
             offset += len(chunk)
         self.dev.ctrl_transfer(VENDOR_CTRL_OUT, 0xA0, 0xE600, 0, bytes([0]), 100) # FX2 RUN
-        print("Loading FX2 complete")
+        log_fw.info("Loading FX2 complete")
 
 
     def load_fpga_fw(self, filename:str):
@@ -279,7 +402,7 @@ class klarty:
                 raise ValueError('Firmware file not found')
 
         fw_file_sz = os.stat(fw_filename).st_size
-        print(f"Loading FPGA bitstream file '{fw_filename}' ({fw_file_sz} bytes)")
+        log_fw.info("Loading FPGA bitstream file '%s' (%d bytes)", fw_filename, fw_file_sz)
         if fw_file_sz < 160e3 or fw_file_sz > 200e3:
             raise ValueError("Bitstream file size doesn't seem correct")
 
@@ -287,7 +410,7 @@ class klarty:
             fw_bin = bytearray(fw.read()) # Read in whole file
 
         fw_crc = zlib.crc32(fw_bin) & 0xffffffff
-        print(f'Firmware CRC: 0x{fw_crc:08X}')
+        log_fw.info('Firmware CRC: 0x%08X', fw_crc, extra={'fw_crc': fw_crc})
 
         # The Kingst FX2 firmware requires notification of FPGA bitstream length prior to loading (FX2CMD_FPGA_PROG_x50_d80 command).
         # However, it is obfuscated for some interlock scheme, a number close to, but not exactly the true file length.
@@ -299,17 +422,17 @@ class klarty:
         if fw_crc == 0x31a1cffe:
             if fw_file_sz != 0x2d000:
                 raise ValueError(f'Bitstream file length is 0x{fw_file_sz:x} which is not 0x2d000 as expected for this file')
-            print('This file is recognised as the LA2016 padded bitstream seen in USB packets between KingstVIS-Win v3.4.2 and the FX2')
+            log_fw.info('This file is recognised as the LA2016 padded bitstream seen in USB packets between KingstVIS-Win v3.4.2 and the FX2')
             bitstream_length_obfuscated = 0x2b8ba # 0x2b8ba is the known obfuscated length for this bitstream
         elif fw_crc == 0x03053104:
             if fw_file_sz != 0x2d000:
                 raise ValueError(f'Bitstream file length is 0x{fw_file_sz:x} which is not 0x2d000 as expected for this file')
-            print('This file is recognised as the LA1016 padded bitstream seen in USB packets between KingstVIS-Win v3.4.2 and the FX2')
+            log_fw.info('This file is recognised as the LA1016 padded bitstream seen in USB packets between KingstVIS-Win v3.4.2 and the FX2')
             bitstream_length_obfuscated = 0x2b8cb # 0x2b8cb is the known obfuscated length for this bitstream
         else:
-            print('This FPGA bitstream is not recognised, it may work but has not been tested on LA1016\\LA2016')
-            print('Be aware the FX2 firmware might have an obfuscated length check on the FPGA bitstream to spoil your fun')
-            print('fbitstream_length_obfuscated has been set to the default, true bitstream length ({bitstream_length_obfuscated} bytes)')
+            log_fw.warning('This FPGA bitstream is not recognised, it may work but has not been tested on LA1016\\LA2016')
+            log_fw.warning('Be aware the FX2 firmware might have an obfuscated length check on the FPGA bitstream to spoil your fun')
+            log_fw.warning('bitstream_length_obfuscated has been set to the default, true bitstream length (%d bytes)', bitstream_length_obfuscated)
         
         self.fpga_hold_in_reset()
 
@@ -333,10 +456,10 @@ class klarty:
             time.sleep(.1)
             self.fpga_release_reset_and_run()
             time.sleep(.1)
-            print("Loading FPGA complete")
+            log_fw.info("Loading FPGA complete")
         else:
-            print(f'Response to FX2CMD_FPGA_PROG_x50_d80 IN request should have been 0x00 but it was 0x{resp[0]:02X}')
-            print("Loading FPGA **FAILED**")
+            log_fw.error('Response to FX2CMD_FPGA_PROG_x50_d80 IN request should have been 0x00 but it was 0x%02X', resp[0])
+            log_fw.error("Loading FPGA **FAILED**")
     
 
     def fpga_hold_in_reset(self):
@@ -379,16 +502,17 @@ class klarty:
     def set_model_identity(self):
         """Best guess at the bytes which determine the model, LA106 or LA2016"""
         unit_type = self.eeprom_read(0x08, 8)
+        self.unit_type = unit_type
         if unit_type == bytes([0x09, 0xF6, 0x00, 0x00, 0x09, 0xF6, 0x10, 0xEF]):
-            print('Unit type: LA1016 (100MHz FPGA clock)')
+            log_dev.info('Unit type: LA1016 (100MHz FPGA clock)')
             self.model = LA_models.LA1016_R2
             self.fpga_clk = 100e6
         elif unit_type == bytes([0x08, 0xF7, 0x00, 0x00, 0x08, 0xF7, 0x10, 0xEF]):
-            print('Unit type: LA2016 (200MHz FPGA clock)')
+            log_dev.info('Unit type: LA2016 (200MHz FPGA clock)')
             self.model = LA_models.LA2016_R2
             self.fpga_clk = 200e6
         else:
-            print('Unit type: Note recognised (using default 200MHz FPGA clock value for capture calculations)')
+            log_dev.warning('Unit type: Not recognised (using default 200MHz FPGA clock value for capture calculations)')
             self.model = LA_models.LA2016_R2
             self.fpga_clk = 200e6
 
@@ -410,8 +534,10 @@ class klarty:
         CMD_READ_KAUTH_ID = bytes([0xa3, 0x01, 0xca])
         self.dev.ctrl_transfer(VENDOR_CTRL_OUT, FX2CMD_KAUTH_x60_d96, 0, 0, CMD_READ_KAUTH_ID, 100)
         time.sleep(0.5)
-        resp = self.dev.ctrl_transfer( VENDOR_CTRL_IN , FX2CMD_KAUTH_x60_d96, 0, 0, 20, 100)
-        self.print_ascii_hex(resp)
+        resp = bytes(self.dev.ctrl_transfer( VENDOR_CTRL_IN , FX2CMD_KAUTH_x60_d96, 0, 0, 20, 100))
+        log_dev.info('%s', HexBytes(resp), extra={'kauth_serial': resp})
+        self.serial = resp
+        return resp
     
 
     def kauth_authenticate(self):
@@ -433,8 +559,9 @@ class klarty:
         CMD_READ_KAUTH_SECURE_CODE = bytes([0xa3, 0x09, 0xc9, 0xf4, 0x32, 0x4c, 0x4d, 0xee, 0xab, 0xa0, 0xdd]) 
         self.dev.ctrl_transfer(VENDOR_CTRL_OUT, FX2CMD_KAUTH_x60_d96, 0, 0, CMD_READ_KAUTH_SECURE_CODE, 100)
         time.sleep(0.5)
-        resp = self.dev.ctrl_transfer( VENDOR_CTRL_IN , FX2CMD_KAUTH_x60_d96, 0, 0, 20, 100)
-        self.print_ascii_hex(resp)
+        resp = bytes(self.dev.ctrl_transfer( VENDOR_CTRL_IN , FX2CMD_KAUTH_x60_d96, 0, 0, 20, 100))
+        log_dev.info('%s', HexBytes(resp), extra={'kauth_response': resp})
+        return resp
 
 
     def eeprom_to_kauth(self):
@@ -502,8 +629,9 @@ class klarty:
         """
 
         PWM_CLOCK = 200e6 # 200MHz in both the LA1016 and LA2016
+        duty_percent = duty
         period = int((PWM_CLOCK / freq) + 0.5)
-        duty = int((period * duty / 100.0) + 0.5)
+        duty = int((period * duty_percent / 100.0) + 0.5)
         p=struct.pack('<LL', period, duty)
         #self.print_ascii_hex(p)
         if channel == 1:
@@ -512,10 +640,11 @@ class klarty:
             self.fpga_write(FPGA_REG_PWM2, p)
         else:
             raise ValueError("Invalid user PWM channel (must be 1 or 2)")
-        print(f'PWM channel {channel}:')
-        print(f'Requested output frequency={freq:#.8g}, duty={duty:#.8g}%')
-        print(f'PWM clock is {PWM_CLOCK/1e6}MHz, 32bit period reg=0x{period:08X}, 32bit duty reg=0x{duty:08X}')
-        print(f'Therefore, actual output frequency={PWM_CLOCK/period:#.8g}Hz, duty={100*duty/period:#.8g}%')
+        log_fpga.info('PWM channel %d: requested output frequency=%#.8gHz, duty=%#.8g%%\n'
+                      'PWM clock is %gMHz, 32bit period reg=0x%08X, 32bit duty reg=0x%08X\n'
+                      'Therefore, actual output frequency=%#.8gHz, duty=%#.8g%%',
+                      channel, freq, duty_percent, PWM_CLOCK/1e6, period, duty, PWM_CLOCK/period, 100*duty/period,
+                      extra={'pwm_channel': channel, 'pwm_period': period, 'pwm_duty': duty})
 
 
     def threshold(self, volts:float):
@@ -533,23 +662,28 @@ class klarty:
 
         if volts > 4.0 or volts < -4.0:
             raise ValueError("Invalid threshold voltage")
-        duty_R79 = 0
         if volts >= 2.9:
             duty_R79 = 0 #OFF, 0V
-            duty_R56 = 302 * volts - 363
         elif volts <= -0.4:
             duty_R79 = 0x02D7 #72% duty
-            duty_R56 = 302 * volts + 1090
         else:
             duty_R79 = 0x00F2 #25% duty
-            duty_R56 = 302 * volts + 121
-        if duty_R56 < 10:
-            duty_R56 = 10 # Catch overflow (Kingst Sw dude, please add this fix to KingstViz)
-        if duty_R56 > 1100:
-            duty_R56 = 1100 # Sensible limit
-        p=struct.pack('<HH', int(duty_R56+0.5), int(duty_R79))
-        self.print_ascii_hex(p,'Threshold PWMs register values: ')
+        slope, offset = self.threshold_lines[duty_R79]
+        duty_R56 = slope * volts + offset
+        if duty_R56 < THRESHOLD_DUTY_R56_MIN:
+            duty_R56 = THRESHOLD_DUTY_R56_MIN # Catch overflow (Kingst Sw dude, please add this fix to KingstViz)
+        if duty_R56 > THRESHOLD_DUTY_R56_MAX:
+            duty_R56 = THRESHOLD_DUTY_R56_MAX # Sensible limit
+        self.threshold_duties(int(duty_R56+0.5), duty_R79, volts)
+
+
+    def threshold_duties(self, duty_R56:int, duty_R79:int, volts:float=None):
+        """Set the threshold PWM duties directly, volts being the threshold they are for if known"""
+        p=struct.pack('<HH', duty_R56, duty_R79)
+        log_fpga.info('Threshold PWMs register values: %s', HexBytes(p),
+                      extra={'threshold_volts': volts, 'duty_R56': duty_R56, 'duty_R79': duty_R79})
         self.fpga_write(FPGA_REG_THRESHOLD, p)
+        self.threshold_volts = volts
 
 
     def get_run_state(self) -> int:
@@ -589,46 +723,144 @@ class klarty:
 
     def start_acquisition(self):
         self.fpga_write(FPGA_REG_RUN, bytes([0x03]))
+        self._t_acquisition_start = time.perf_counter()
 
 
     def stop_acquisition(self):
         #These bytes are written seperately by OEM software, so doing the same here.
         self.fpga_write(FPGA_REG_RUN + 1, bytes([1]))  #Write Reg1=1 (which is also done automatically by the FX2CMD_START_BULK_TRANSFER_x30_d48)
         self.fpga_write(FPGA_REG_RUN, bytes([0x00]))   #Write Reg0=0
+        if self._t_acquisition_start is not None:
+            self.metrics['capture_duration'] = time.perf_counter() - self._t_acquisition_start
+            self._t_acquisition_start = None
 
 
     def stop_sampling(self):
         self.fpga_write(FPGA_REG_RUN + 3, bytes([0])) #within sigrok la2016_setup_acquisition()
 
 
+    def wait_for_capture(self, timeout:float=20.0, poll_interval:float=0.01) -> bool:
+        """Poll the run state until the capture is complete, returns False on timeout"""
+        t_end = time.perf_counter() + timeout
+        while (self.get_run_state() & 0x000F) != RUN_STATE_COMPLETE:
+            if time.perf_counter() > t_end:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+
+    def arm(self, sample_rate, n_samples, capture_ratio_percent) -> CapturePlan:
+        """Configure and start a capture without waiting for it, see upload()"""
+
+        if self.serial is None:
+            self.kauth_read_serial() # Once, for capture_metadata()
+        self.stop_sampling()
+        self.set_trigger_config(verbose=False)
+        plan = self.set_sample_config(sample_rate, n_samples, capture_ratio_percent)
+        self.start_acquisition()
+        return plan
+
+
+    def upload(self) -> CaptureInfo:
+        """Stop the capture started by arm() then upload and save it
+
+        The name of the saved file is in self.metrics['capture_file'].
+        """
+
+        self.stop_acquisition()
+        ci = self.capture_info()
+        self.capture_upload(ci.n_rep_packets, ci.write_pos, ci.n_rep_packets_before_trigger)
+        return ci
+
+
+    def capture(self, sample_rate, n_samples, capture_ratio_percent, timeout:float=20.0) -> CaptureInfo:
+        """Run one capture and save it to file, the same steps as klarty-03-capture-now.py
+
+        The name of the saved file is in self.metrics['capture_file'].
+        """
+
+        self.arm(sample_rate, n_samples, capture_ratio_percent)
+        if not self.wait_for_capture(timeout):
+            self.stop_acquisition()
+            raise TimeoutError(f'Capture not complete after {timeout}sec')
+        return self.upload()
+
+
     def has_triggered(self) -> bool:
         if self.get_run_state() & 0x04:
             return True
         return False
     
 
-    def set_sample_config(self, sample_rate, n_samples, capture_ratio_percent):
-        """Setup sampling parameters for next capture
+    def plan_capture(self, sample_rate, n_samples, capture_ratio_percent) -> CapturePlan:
+        """Predict SDRAM usage and upload time for a capture
 
-        capture_ratio_percent controls what proportion of n_samples is captured
-        before the trigger event.
+        The number of repetition packets stored depends on signal activity. Idle inputs need
+        one repetition packet per MAX_REP_COUNT samples, inputs changing every sample need one
+        repetition packet per sample. The plan gives both ends of that range, with upload times
+        estimated from the USB throughput measured during the last upload.
         """
 
-        # clock_divisor
-        sample_clock_divisor = int ((self.fpga_clk / sample_rate) + 0.5)
+        sample_clock_divisor = int((self.fpga_clk / sample_rate) + 0.5)
         if sample_clock_divisor > 0xffff:
             sample_clock_divisor = 0xffff
-        self.curr_samplerate = self.fpga_clk / sample_clock_divisor
-        # capture_ratio_percent determines number of samples stored prior to trigger event
-        SAMPLE_MEM_SZ_BYTES = 128 * 1024 * 1024
+        if sample_clock_divisor < 1:
+            sample_clock_divisor = 1
+        n_samples = int(n_samples)
         pre_trigger_samples = int((capture_ratio_percent * n_samples) / 100)
+        min_rep_packets = -(-n_samples // MAX_REP_COUNT)
+        max_rep_packets = min(n_samples, MAX_REP_PKTS_IN_MEM)
+        min_bytes = rep_packets_to_nbytes(min_rep_packets)
+        max_bytes = rep_packets_to_nbytes(max_rep_packets)
+        # The FPGA register gets the OEM software's value, the same proportion of the SDRAM,
+        # although the pre-trigger samples never need more than max_pre_trigger_bytes of it.
         pre_trigger_mem_bytes = int((capture_ratio_percent * SAMPLE_MEM_SZ_BYTES) / 100)
         pre_trigger_mem_bytes = pre_trigger_mem_bytes & 0x00FFFFFF00 #Clear low byte
-        capture_time = sample_clock_divisor * n_samples/self.fpga_clk
-        p=struct.pack('<LBLLHB', int(n_samples), 0, pre_trigger_samples, pre_trigger_mem_bytes, sample_clock_divisor,0)
-        print(f'\nSample config: {int(n_samples)} samples at {200e3/sample_clock_divisor}kHz rate ({int(capture_time)}sec capture) with {capture_ratio_percent}% pre-trigger samples.')
-        self.print_ascii_hex(p,'Sampling Config FPGA Register Values:')
+        max_pre_trigger_bytes = min(rep_packets_to_nbytes(pre_trigger_samples), pre_trigger_mem_bytes)
+        return CapturePlan(sample_rate=self.fpga_clk / sample_clock_divisor,
+                           sample_clock_divisor=sample_clock_divisor,
+                           n_samples=n_samples,
+                           pre_trigger_samples=pre_trigger_samples,
+                           capture_time=sample_clock_divisor * n_samples / self.fpga_clk,
+                           min_rep_packets=min_rep_packets,
+                           max_rep_packets=max_rep_packets,
+                           min_bytes=min_bytes,
+                           max_bytes=max_bytes,
+                           pre_trigger_mem_bytes=pre_trigger_mem_bytes,
+                           max_pre_trigger_bytes=max_pre_trigger_bytes,
+                           min_upload_time=min_bytes / self.upload_bytes_per_sec,
+                           max_upload_time=max_bytes / self.upload_bytes_per_sec)
+
+
+    def log_capture_plan(self, plan:CapturePlan):
+        log_capture.info('Capture plan: %d samples at %gkHz (%.6gsec capture)\n'
+                         'Repetition packets: %d (idle inputs) to %d (changing every sample)\n'
+                         'SDRAM usage: %d to %d bytes, pre-trigger region %d bytes (at most %d used)\n'
+                         'Upload time: %.3fms to %.3fms at %.3fMB/s',
+                         plan.n_samples, plan.sample_rate/1e3, plan.capture_time,
+                         plan.min_rep_packets, plan.max_rep_packets,
+                         plan.min_bytes, plan.max_bytes, plan.pre_trigger_mem_bytes, plan.max_pre_trigger_bytes,
+                         plan.min_upload_time*1e3, plan.max_upload_time*1e3, self.upload_bytes_per_sec/1e6,
+                         extra={'capture_plan': plan})
+
+
+    def set_sample_config(self, sample_rate, n_samples, capture_ratio_percent):
+        """Setup sampling parameters for next capture
+
+        capture_ratio_percent controls what proportion of n_samples is captured
+        before the trigger event.
+        """
+
+        plan = self.plan_capture(sample_rate, n_samples, capture_ratio_percent)
+        self.curr_samplerate = plan.sample_rate
+        self.metrics['capture_plan'] = plan
+        p=struct.pack('<LBLLHB', plan.n_samples, 0, plan.pre_trigger_samples, plan.pre_trigger_mem_bytes, plan.sample_clock_divisor,0)
+        log_fpga.info('Sample config: %d samples at %gkHz rate (%.6gsec capture) with %g%% pre-trigger samples.\n'
+                      'Sampling Config FPGA Register Values: %s',
+                      plan.n_samples, plan.sample_rate/1e3, plan.capture_time, capture_ratio_percent, HexBytes(p),
+                      extra={'capture_plan': plan})
         self.fpga_write(FPGA_REG_SAMPLING, p)
+        return plan
 
 
     def set_trigger_config(self, verbose=True):
@@ -650,15 +882,15 @@ class klarty:
         p=struct.pack('<LLLL', channel_enable, trigger_enable, trigger_type, trigger_sense)
         self.fpga_write(FPGA_REG_TRIGGER, p)
 
-        if verbose == False:
+        if verbose == False or not log_fpga.isEnabledFor(logging.INFO):
             return
 
-        print('\nCH15   TRIGGER    CH0')
-        print(f'   {channel_enable:016b} Enabled Channels')
-        print(f'   {trigger_enable:016b} Trigger Enable')
-        print(f'   {trigger_type:016b} Trigger Type 0=EDGE 1=LEVEL')
-        print(f'   {trigger_sense:016b} Trigger Sense 0=LOW/RISING  1=HIGH/FALLING')
-        self.print_ascii_hex(p,'Trigger Config FPGA Register Values:')
+        log_fpga.info('CH15   TRIGGER    CH0\n'
+                      f'   {channel_enable:016b} Enabled Channels\n'
+                      f'   {trigger_enable:016b} Trigger Enable\n'
+                      f'   {trigger_type:016b} Trigger Type 0=EDGE 1=LEVEL\n'
+                      f'   {trigger_sense:016b} Trigger Sense 0=LOW/RISING  1=HIGH/FALLING\n'
+                      'Trigger Config FPGA Register Values: %s', HexBytes(p))
 
 
     def capture_info(self, verbose=True):
@@ -673,33 +905,50 @@ class klarty:
         """
 
         resp = self.fpga_read(FPGA_REG_SAMPLING, 12)        
-        CaptureInfo = namedtuple("CaptureInformation", ["n_rep_packets", "n_rep_packets_before_trigger", "write_pos"])
         ci = CaptureInfo(*struct.unpack('<LLL', resp))
+        self.metrics['capture_info'] = ci
         if verbose:
-            print('\nCapture info:')
-            self.print_ascii_hex(resp, 'FPGA read bytes:')
-            print(f'n_rep_packets: {ci.n_rep_packets}\nn_rep_packets_before_trigger: {ci.n_rep_packets_before_trigger}\nwrite_pos: {ci.write_pos}')
+            log_capture.info('Capture info:\nFPGA read bytes: %s\n'
+                             'n_rep_packets: %d\nn_rep_packets_before_trigger: %d\nwrite_pos: %d',
+                             HexBytes(resp), ci.n_rep_packets, ci.n_rep_packets_before_trigger, ci.write_pos,
+                             extra={'capture_info': ci})
             if ci.n_rep_packets % 5:
-                print(f'WARNING: number of packets is not multiples of 5 as expected: {ci.n_rep_packets}')
+                log_capture.warning('Number of packets is not multiples of 5 as expected: %d', ci.n_rep_packets)
         return ci
 
     
-    def capture_upload(self, n_rep_packets, write_pos):
+    def upload_span(self, n_rep_packets, write_pos, n_rep_packets_before_trigger=0) -> UploadSpan:
+        """Work out exactly which SDRAM bytes hold the last capture
+
+        The capture ends at write_pos and occupies whole transfer packets, the last one
+        possibly part filled. trigger_offset is the byte offset of the first post-trigger
+        repetition packet within the uploaded data.
+        """
+
+        n_bytes = min(rep_packets_to_nbytes(n_rep_packets), SAMPLE_MEM_SZ_BYTES)
+        start_pos = (int(write_pos) - n_bytes) % SAMPLE_MEM_SZ_BYTES
+        trigger_offset = rep_packet_offset(n_rep_packets_before_trigger)
+        return UploadSpan(start_pos, n_bytes, trigger_offset)
+
+
+    def capture_upload(self, n_rep_packets, write_pos, n_rep_packets_before_trigger=0, buffer=None):
         """Retrieve captured data
 
         Retrieve data from SDRAM via FX2 FIFO port to FPGA connection.
         USB bulk HS is 512 bytes per packet. IN endpoint number is 0x86.
         Each data sample ("Repetition Packet") is a 16-bit input state plus 8 bit repetition count
         Each transfer packet is 5 Repetition Packets plus an 8 bit sequence number
+        Only the transfer packets holding the capture are uploaded, see upload_span().
+        See capture_upload_nbytes() for buffer.
         """
 
-        SIZEOF_TRANSFER_PKT = ((2+1)*5)+1
-        n_transfer_packets_to_read = int(n_rep_packets / 5)
-        n_bytes_to_read = n_transfer_packets_to_read * SIZEOF_TRANSFER_PKT
-        self.capture_upload_nbytes(n_bytes_to_read, write_pos)
+        span = self.upload_span(n_rep_packets, write_pos, n_rep_packets_before_trigger)
+        log_capture.info('Capture is %d repetition packets in %d bytes, trigger at byte offset %d',
+                         n_rep_packets, span.n_bytes, span.trigger_offset, extra={'upload_span': span})
+        return self.capture_upload_nbytes(span.n_bytes, write_pos, buffer)
 
 
-    def capture_upload_nbytes(self, n_bytes:int, write_pos:int):
+    def capture_upload_nbytes(self, n_bytes:int, write_pos:int, buffer=None):
         """Retrieve n_bytes of data from SDRAM, starting at (write_pos - n_bytes)
         
         n_bytes is approximate to nearest 4 bytes. Seems to be chunk size of 4 bytes.
@@ -709,18 +958,24 @@ class klarty:
         If a trigger is enabled and the LA has to enter the 'waiting for trigger' state
         then the upload will start from a higher address (unless it happens to have
         wrapped through memory, but you get the idea).
+
+        Normally the data is saved to file and returned. If buffer is given (any writable
+        buffer of at least n_bytes, e.g. SharedMemory.buf) the data is read straight into it,
+        not saved, and a memoryview of the bytes read is returned.
         """
 
-        MAX_MEM_ADDR_128MB = (128*1024*1024)-1
+        MAX_MEM_ADDR_128MB = SAMPLE_MEM_SZ_BYTES-1
         n_bytes = int(n_bytes)
         write_pos = int(write_pos)
         if write_pos < 0 or write_pos > MAX_MEM_ADDR_128MB:
             raise ValueError('Memory address pointer not in expected range')
         if n_bytes == 0:
-            print('Upload of 0 bytes requested, ignoring.')
+            log_capture.warning('Upload of 0 bytes requested, ignoring.')
             return
         if n_bytes < 0 or n_bytes > MAX_MEM_ADDR_128MB:
             raise ValueError('Number of bytes to retrieve not in expected range')
+        if buffer is not None and len(buffer) < n_bytes:
+            raise ValueError(f'Buffer of {len(buffer)} bytes is too small for {n_bytes} bytes')
         if n_bytes <= write_pos:
             start_pos = int(write_pos - n_bytes)
         else:
@@ -729,27 +984,69 @@ class klarty:
             # must be to handle pre-trigger capture (I think)
             start_pos = int(write_pos + MAX_MEM_ADDR_128MB + 1 - n_bytes)
         
-        print(f'\nReading {n_bytes} bytes starting from SDRAM address 0x{start_pos:X}')
+        log_capture.info('Reading %d bytes starting from SDRAM address 0x%X', n_bytes, start_pos)
         self.dev.ctrl_transfer(VENDOR_CTRL_OUT, FX2CMD_RESET_BULK_TRANSFER_x38_d56, 0, 0, None, 100)
         p= struct.pack('<LL', start_pos, n_bytes)
-        self.print_ascii_hex(p, 'Upload FPGA Register Values: ')
+        log_capture.debug('Upload FPGA Register Values: %s', HexBytes(p))
         self.fpga_write(FPGA_REG_UPLOAD, p) #Tell FPGA the start position and n_bytes for this bulk read
         #time.sleep(0.02) # Just in case FPGA needs a few ms to prepare??..unlikely.
         self.dev.ctrl_transfer(VENDOR_CTRL_OUT, FX2CMD_START_BULK_TRANSFER_x30_d48, 0, 0, None, 100)
         ENDPOINT_BULK_IN = 0x86
-        data = self.dev.read(ENDPOINT_BULK_IN, n_bytes)  #TODO this is losing bytes in large transfers >20MB, try pre-allocating storage buffer
-        self.capture_data_to_file(data)
+        t_start = time.perf_counter()
+        if buffer is None:
+            # Fallback, PyUSB allocates the array. This was seen losing bytes in transfers over 20MB,
+            # pass a preallocated buffer for those (as klarty_shm does)
+            data = self.dev.read(ENDPOINT_BULK_IN, n_bytes)
+        else:
+            with ReadBuffer(buffer, n_bytes) as read_buffer:
+                n_read = self.dev.read(ENDPOINT_BULK_IN, read_buffer)
+            data = memoryview(buffer)[:n_read]
+        t_upload = time.perf_counter() - t_start
+        if t_upload > 0 and len(data) > 0:
+            self.upload_bytes_per_sec = len(data) / t_upload
+        self.metrics.update(upload_bytes_requested=n_bytes, upload_bytes=len(data), upload_time=t_upload,
+                            upload_bytes_per_sec=self.upload_bytes_per_sec)
+        log_capture.info('Uploaded %d bytes in %.3fms (%.3fMB/s)', len(data), t_upload*1e3, self.upload_bytes_per_sec/1e6,
+                         extra={'upload_bytes': len(data), 'upload_time': t_upload})
+        if buffer is None:
+            self.capture_data_to_file(data)
+        return data
         
         
-    def capture_data_to_file(self, data:bytes):
+    def capture_data_to_file(self, data:bytes) -> str:
         fname = datetime.now().isoformat()
-        fname = fname[:19].replace(':','-') + '.bin'
-        fpathname = os.path.join('captures',fname)
-        print(f'Saving {len(data)} bytes of data to .\\{fpathname}')
+        fname = fname[:19].replace(':','-')
+        fpathname = os.path.join('captures',fname + '.bin')
+        n = 1
+        while os.path.exists(os.path.join(os.path.dirname(__file__), fpathname)):
+            # More than one capture within a second
+            fpathname = os.path.join('captures',f'{fname}-{n}.bin')
+            n += 1
+        log_capture.info('Saving %d bytes of data to .\\%s', len(data), fpathname)
         fpathname = os.path.join(os.path.dirname(__file__), fpathname)
         os.makedirs(os.path.dirname(fpathname), exist_ok=True)
         with open(fpathname, "wb") as f:
             f.write(data)
+        self.metrics['capture_file'] = fpathname
+        if self.catalog is not None:
+            self.catalog.add_later(fpathname, **self.capture_metadata()) # Decodes the file, not on the upload path
+        return fpathname
+
+
+    def capture_metadata(self) -> dict:
+        """Device identity and settings of the last capture, as kept by the catalog"""
+        plan = self.metrics.get('capture_plan')
+        ci = self.metrics.get('capture_info')
+        return {'model': self.model.name,
+                'unit_type': self.unit_type.hex() if self.unit_type else None,
+                'serial': self.serial.hex() if self.serial else None,
+                'sample_rate': plan.sample_rate if plan else None,
+                'n_samples': plan.n_samples if plan else None,
+                'pre_trigger_samples': plan.pre_trigger_samples if plan else None,
+                'threshold_volts': self.threshold_volts,
+                'n_rep_packets': ci.n_rep_packets if ci else None,
+                'n_rep_packets_before_trigger': ci.n_rep_packets_before_trigger if ci else 0,
+                'write_pos': ci.write_pos if ci else None}
 
 #--------------------------
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# The capture analysis code in one namespace, for scripts and batch jobs which work on saved
+# captures and never touch an analyser.
+#
+# Nothing is imported until first used: importing this module costs well under a millisecond,
+# and each name loads its module (and NumPy) on first access. PyUSB and the device code in
+# klarty.py are never imported. Short-lived analysis processes therefore only pay for what
+# they use, e.g. a catalog query never loads NumPy.
+#
+#   import klarty_analysis as ka
+#   cap = ka.read_capture_file('captures/2021-01-13T13-15-51.bin', 1e5)
+#   ka.print_measurements(ka.measure(cap, channels=[0, 1]))
+#
+# Import times are part of the cost of each process, `python klarty_analysis.py` checks them
+# against IMPORT_BUDGETS, each import in a fresh interpreter. Modules which import next to nothing
+# only have what they import checked, their times are mostly the machine's.
+
+import os
+import sys
+
+EXPORTS = {
+    'klarty_format':  ('SAMPLE_MEM_SZ_BYTES', 'SIZEOF_REP_PKT', 'N_REP_PKTS_PER_TRANSFER_PKT', 'SIZEOF_TRANSFER_PKT',
+                       'MAX_REP_COUNT', 'MAX_REP_PKTS_IN_MEM', 'N_CHANNELS', 'rep_packets_to_nbytes', 'rep_packet_offset'),
+    'klarty_capture': ('REP_PKT_DTYPE', 'TRANSFER_PKT_DTYPE', 'ChannelRuns', 'Capture', 'decode_rep_packets',
+                       'sequence_errors', 'decode', 'read_capture_file', 'iter_rep_packets', 'CaptureWriter',
+                       'write_capture_file'),
+    'klarty_measure': ('ChannelTiming', 'measure_edges', 'measure', 'print_measurements'),
+    'klarty_compare': ('ChannelDiff', 'Comparison', 'level_at', 'mismatch_intervals', 'compare', 'passed',
+                       'print_comparison'),
+    'klarty_extract': ('ExtractInfo', 'Decimator', 'decimate', 'source_trigger_sample', 'extract'),
+    'klarty_bus':     ('BusWords', 'word_table', 'strobe_runs', 'decode_bus', 'word_times', 'print_words'),
+    'klarty_catalog': ('CatalogEntry', 'ChannelSummary', 'summarise_channels', 'Catalog', 'print_entries'),
+}
+_MODULES = {name: module for module, names in EXPORTS.items() for name in names}
+__all__ = list(_MODULES)
+
+
+def __getattr__(name:str):
+    module = _MODULES.get(name)
+    if module is None:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    value = getattr(__import__(module), name)
+    globals()[name] = value # Later lookups don't come through here
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+# Module: (budget, excluded), budget is the cumulative import time in ms (None to not check it) and
+# excluded the modules it must not import. Plain tuples, as collections.namedtuple alone would cost
+# more than importing this module.
+IMPORT_BUDGETS = {
+    'klarty_analysis': (None, ('numpy', 'usb', 'klarty')),
+    'klarty_format':   (None, ('numpy', 'usb', 'klarty')),
+    'klarty_catalog':  (20,  ('numpy', 'usb', 'klarty')),
+    'klarty':          (40,  ('numpy', 'usb')),
+    'klarty_capture':  (150, ('usb', 'klarty')),
+    'klarty_measure':  (150, ('usb', 'klarty')),
+    'klarty_compare':  (150, ('usb', 'klarty')),
+    'klarty_extract':  (150, ('usb', 'klarty')),
+    'klarty_bus':      (150, ('usb', 'klarty')),
+}
+
+
+def import_time(module:str, excluded=(), repeat:int=5) -> tuple:
+    """Best of repeat import times of module in ms, each in a new interpreter, and which of excluded it imported"""
+    import subprocess
+    check = f'import sys, {module}; print(",".join(m for m in {tuple(excluded)!r} if m in sys.modules))'
+    best = None
+    for _ in range(repeat):
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', check], capture_output=True, text=True, check=True,
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+        # Lines are 'import time: self [us] | cumulative | imported package', the module's own line is after its imports
+        t = None
+        for line in p.stderr.splitlines():
+            fields = [f.strip() for f in line.split('|')]
+            if len(fields) == 3 and fields[2] == module:
+                t = int(fields[1]) / 1e3
+        if t is None:
+            raise ValueError(f'No import time for {module} in the -X importtime output')
+        best = t if best is None else min(best, t)
+    imported = p.stdout.strip()
+    return best, imported.split(',') if imported else []
+
+
+def check_import_times(budgets:dict=IMPORT_BUDGETS, repeat:int=5) -> bool:
+    """Print the import time of each module against its budget, True if all are within budget"""
+    ok = True
+    print('module              time    budget')
+    for module, (budget, excluded) in budgets.items():
+        t, imported = import_time(module, excluded, repeat)
+        problem = f'imports {", ".join(imported)}' if imported else 'over budget' if budget is not None and t > budget else 'ok'
+        print(f'{module:16s} {t:6.1f}ms {f"{budget:.0f}ms" if budget is not None else "-":>8s} {problem}')
+        ok = ok and problem == 'ok'
+    return ok
+
+if __name__=="__main__":
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] [MODULE ...]')
+    parser.add_option('-n', '--repeat', dest='repeat', help='best of this many imports of each module', type='int', default=5)
+    (options, args) = parser.parse_args()
+    budgets = {m: b for m, b in IMPORT_BUDGETS.items() if not args or m in args}
+    sys.exit(0 if check_import_times(budgets, options.repeat) else 1)
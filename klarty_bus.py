@@ -0,0 +1,155 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Parallel bus (state mode) decoding: the data channels are read at each edge of a strobe or
+# clock channel, giving one bus word per edge.
+#
+# Strobe edges are found from the capture's runs (see Capture.changes()), so there is no per
+# sample work. The input state at every edge is gathered in one indexing operation and
+# turned into a bus word by a 64k entry lookup table, which allows any channel to bit
+# mapping at the same cost as a plain shift and mask.
+#
+#   cap = klarty_capture.read_capture_file('captures/2021-01-13T13-15-51.bin', 1e5)
+#   words = klarty_bus.decode_bus(cap, data_channels=range(8), strobe=8, edge='falling')
+#   for t, value in zip(klarty_bus.word_times(cap, words)[:10], words.values[:10]):
+#       print(f'{t:.9f} {value:02X}')
+
+from collections import namedtuple
+
+import numpy as np
+
+from klarty_capture import read_capture_file, N_CHANNELS
+
+# samples: uint64 sample number of each strobe edge, values: bus word read at each edge,
+# uint8 for buses of up to 8 bits otherwise uint16
+BusWords = namedtuple("BusWords", ["samples", "values"])
+
+EDGES = ('rising', 'falling', 'both')
+
+
+def _check_channel(channel:int):
+    if not 0 <= channel < N_CHANNELS:
+        raise ValueError(f'Channel {channel} is not 0 to {N_CHANNELS - 1}')
+
+
+def word_table(data_channels):
+    """Lookup table from 16bit input state to bus word, data_channels[i] being the channel of bus bit i"""
+    data_channels = list(data_channels)
+    if not 0 < len(data_channels) <= N_CHANNELS:
+        raise ValueError(f'A bus needs 1 to {N_CHANNELS} data channels, not {len(data_channels)}')
+    for ch in data_channels:
+        _check_channel(ch)
+    states = np.arange(1 << N_CHANNELS, dtype=np.uint16)
+    table = np.zeros(len(states), dtype=np.uint8 if len(data_channels) <= 8 else np.uint16)
+    for bit, ch in enumerate(data_channels):
+        table |= ((states >> np.uint16(ch)) & 1).astype(table.dtype) << table.dtype.type(bit)
+    return table
+
+
+def strobe_runs(cap, strobe:int, edge:str='rising'):
+    """Indexes of the runs starting with the given edge of the strobe channel"""
+    _check_channel(strobe)
+    if edge not in EDGES:
+        raise ValueError(f'Edge {edge!r} is not one of {", ".join(EDGES)}')
+    mask = np.uint16(1 << strobe)
+    idx, changed = cap.changes()
+    idx = idx[(changed & mask) != 0]
+    if edge != 'both':
+        # Edges alternate, the first is rising if the strobe starts low
+        initial_level = bool(cap.values[0] & mask) if len(cap) else False
+        idx = idx[int((edge == 'rising') == initial_level)::2]
+    return idx
+
+
+def decode_bus(cap, data_channels, strobe:int, edge:str='rising', delay:int=0, enable:tuple=None) -> BusWords:
+    """Bus words read at each edge of strobe
+
+    The data is the input state delay samples after the edge, so delay=-1 reads the state
+    just before the edge for data which changes on the strobe edge. enable is an optional
+    (channel, level) which must hold at the same sample for the word to count, e.g. a chip
+    select (cs, 0). Edges whose delayed sample is outside the capture are dropped.
+    """
+    table = word_table(data_channels)
+    idx = strobe_runs(cap, strobe, edge)
+    samples = cap.starts[idx]
+    if delay:
+        at = samples.astype(np.int64) + delay
+        inside = (at >= cap.start) & (at < cap.end)
+        samples, at, idx = samples[inside], at[inside].astype(np.uint64), idx[inside]
+        # The delayed sample is nearly always in the run before the edge (delay < 0) or the run
+        # the edge starts (delay > 0), only the others need searching for
+        if delay < 0:
+            idx -= 1
+            elsewhere = cap.starts[idx] > at
+        else:
+            following = np.minimum(idx + 1, len(cap) - 1)
+            elsewhere = (idx + 1 < len(cap)) & (cap.starts[following] <= at)
+        elsewhere = np.flatnonzero(elsewhere)
+        idx[elsewhere] = np.searchsorted(cap.starts, at[elsewhere], side='right') - 1
+    states = cap.values[idx]
+    if enable is not None:
+        channel, level = enable
+        _check_channel(channel)
+        selected = ((states >> np.uint16(channel)) & 1) == (1 if level else 0)
+        samples, states = samples[selected], states[selected]
+    return BusWords(samples, table[states])
+
+
+def word_times(cap, words:BusWords):
+    """Time of each word in seconds relative to the trigger"""
+    return (words.samples.astype(np.float64) - cap.trigger_sample) / cap.sample_rate
+
+
+def print_words(cap, words:BusWords, n:int=None):
+    digits = 2 * words.values.itemsize
+    times = word_times(cap, BusWords(words.samples[:n], words.values[:n]))
+    for t, value in zip(times, words.values[:n]):
+        print(f'{t:14.9f} {value:0{digits}X}')
+
+
+def parse_channels(text:str) -> list:
+    """Channels from '0-7' or '0,1,2,3' style lists, in bus bit order"""
+    channels = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        channels.extend(range(int(first), int(last) + 1) if last else [int(first)])
+    return channels
+
+
+def main(fname, sample_rate, trigger, data_channels, strobe, edge, delay, enable, n):
+    cap = read_capture_file(fname, sample_rate, trigger)
+    words = decode_bus(cap, data_channels, strobe, edge, delay, enable)
+    print_words(cap, words, n)
+    print(f'{len(words.values)} words')
+
+if __name__=="__main__":
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] CAPTURE.bin')
+    parser.add_option('-r', '--rate',    dest='rate',    help='sample rate of the capture, Hz', type='float')
+    parser.add_option('-t', '--trigger', dest='trigger', help='n_rep_packets_before_trigger of the capture', type='int', default=0)
+    parser.add_option('-d', '--data',    dest='data',    help='data channels from bit 0 up, e.g. 0-7 or 3,2,1,0', default='0-7')
+    parser.add_option('-s', '--strobe',  dest='strobe',  help='strobe or clock channel', type='int')
+    parser.add_option('-e', '--edge',    dest='edge',    help='strobe edge: rising, falling or both', default='rising')
+    parser.add_option('-D', '--delay',   dest='delay',   help='read the data this many samples after the edge', type='int', default=0)
+    parser.add_option('-E', '--enable',  dest='enable',  help='CH:LEVEL which must hold for a word to count, e.g. 12:0')
+    parser.add_option('-n', '--count',   dest='count',   help='print at most this many words', type='int', default=20)
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or options.rate is None or options.strobe is None:
+        parser.error('Need --rate, --strobe and a capture file')
+    enable = tuple(int(x) for x in options.enable.split(':')) if options.enable else None
+    main(args[0], options.rate, options.trigger, parse_channels(options.data), options.strobe, options.edge,
+         options.delay, enable, options.count)
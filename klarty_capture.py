@@ -0,0 +1,358 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Decoding of uploaded capture data, as saved by klarty.capture_data_to_file().
+#
+# The data is a sequence of 16 byte transfer packets, each holding five repetition packets
+# (16bit input state, 8bit repeat count) and an 8bit sequence number. The 8bit counts mean a
+# long idle line is thousands of identical repetition packets, so decoding merges consecutive
+# packets with the same input state into one run. A Capture is then just two arrays: the
+# input state of each run and the sample number at which it starts.
+#
+#   cap = klarty_capture.read_capture_file('captures/2021-01-13T13-15-51.bin', 1e5)
+#   burst = cap.slice(0.5, 0.6)  # Views of cap's arrays, nothing is copied
+#
+# Analyses of single channels use cap.channel(n), the sample numbers at which channel n
+# changes, worked out on first use and cached. cap.project([scl, sda]) is a Capture of only
+# those channels, with runs merged again so activity on the other channels costs nothing.
+
+from collections import namedtuple
+
+import numpy as np
+
+from klarty_format import SIZEOF_TRANSFER_PKT, N_REP_PKTS_PER_TRANSFER_PKT, MAX_REP_COUNT, N_CHANNELS
+
+REP_PKT_DTYPE = np.dtype([('state', '<u2'), ('count', 'u1')])
+TRANSFER_PKT_DTYPE = np.dtype([('rep', REP_PKT_DTYPE, (N_REP_PKTS_PER_TRANSFER_PKT,)), ('seq', 'u1')])
+assert TRANSFER_PKT_DTYPE.itemsize == SIZEOF_TRANSFER_PKT
+
+# initial_level: channel level at the capture start, edges: uint64 sample numbers at which the
+# channel changes, levels: bool channel level after each edge
+ChannelRuns = namedtuple("ChannelRuns", ["channel", "initial_level", "edges", "levels"])
+
+
+class Capture:
+    """Input states as runs of equal samples
+
+    values: uint16 input state of each run, starts: uint64 sample number of the start of each
+    run, increasing and with no two consecutive runs of the same value. The capture covers
+    samples start to end; after slicing the first run may start before start.
+    Sample numbers are always those of the whole capture, so edge times from a slice can be
+    compared directly with the original. trigger_sample is the first post-trigger sample.
+    """
+
+    def __init__(self, values, starts, sample_rate:float, start:int=0, end:int=None, trigger_sample:int=0):
+        if len(values) != len(starts):
+            raise ValueError(f'{len(values)} values but {len(starts)} starts')
+        self.values = values
+        self.starts = starts
+        self.sample_rate = sample_rate
+        self.start = int(start)
+        self.end = int(end) if end is not None else self.start
+        self.trigger_sample = int(trigger_sample)
+        self._changes = None
+        self._channels = {}
+        self._projections = {}
+
+
+    @classmethod
+    def from_samples(cls, samples, sample_rate:float, trigger_sample:int=0):
+        """Capture from one uint16 input state per sample"""
+        samples = np.asarray(samples, dtype=np.uint16)
+        starts = np.flatnonzero(samples[1:] != samples[:-1]) + 1
+        starts = np.concatenate(([0], starts)).astype(np.uint64) if len(samples) else starts.astype(np.uint64)
+        return cls(samples[starts], starts, sample_rate, 0, len(samples), trigger_sample)
+
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+    def __repr__(self) -> str:
+        return (f'Capture({len(self)} runs, samples {self.start}-{self.end} at {self.sample_rate:g}Hz, '
+                f'trigger at {self.trigger_sample})')
+
+
+    @property
+    def n_samples(self) -> int:
+        return self.end - self.start
+
+
+    @property
+    def duration(self) -> float:
+        return self.n_samples / self.sample_rate
+
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.starts.nbytes
+
+
+    def sample_number(self, t:float) -> int:
+        """Sample number at time t seconds relative to the trigger, clipped to the capture"""
+        return min(max(self.trigger_sample + int(round(t * self.sample_rate)), self.start), self.end)
+
+
+    def run_index(self, sample:int) -> int:
+        """Index of the run holding sample"""
+        return int(np.searchsorted(self.starts, np.uint64(sample), side='right')) - 1
+
+
+    def slice_samples(self, start:int, end:int):
+        """Capture of samples start to end, sharing this capture's arrays"""
+        start = min(max(int(start), self.start), self.end)
+        end = min(max(int(end), start), self.end)
+        i0 = max(self.run_index(start), 0)
+        i1 = int(np.searchsorted(self.starts, np.uint64(end), side='left'))
+        if end == start:
+            i1 = i0
+        return Capture(self.values[i0:i1], self.starts[i0:i1], self.sample_rate, start, end, self.trigger_sample)
+
+
+    def slice(self, t_start:float, t_end:float):
+        """Capture of times t_start to t_end seconds relative to the trigger, sharing this capture's arrays"""
+        return self.slice_samples(self.sample_number(t_start), self.sample_number(t_end))
+
+
+    def durations(self):
+        """Number of samples in each run, clipped to the capture"""
+        bounds = np.empty(len(self) + 1, dtype=np.uint64)
+        bounds[:-1] = self.starts
+        bounds[-1] = self.end
+        if len(self):
+            bounds[0] = self.start
+        return np.diff(bounds)
+
+
+    def samples(self):
+        """One uint16 input state per sample, for short captures or slices"""
+        return np.repeat(self.values, self.durations().astype(np.intp))
+
+
+    def state_at(self, sample:int) -> int:
+        """Input state at sample"""
+        if not self.start <= sample < self.end:
+            raise ValueError(f'Sample {sample} is outside the capture, {self.start} to {self.end}')
+        return int(self.values[self.run_index(sample)])
+
+
+    def changes(self) -> tuple:
+        """Indexes of the runs after which any channel changes, and the bits that changed"""
+        if self._changes is None:
+            changed = self.values[1:] ^ self.values[:-1]
+            idx = np.flatnonzero(changed)
+            self._changes = (idx + 1, changed[idx])
+        return self._changes
+
+
+    def active_channels(self) -> list:
+        """Channels with at least one edge"""
+        bits = int(np.bitwise_or.reduce(self.changes()[1])) if len(self) > 1 else 0
+        return [ch for ch in range(N_CHANNELS) if bits & (1 << ch)]
+
+
+    def channel(self, channel:int) -> ChannelRuns:
+        """Edges of one channel, cached after the first call"""
+        runs = self._channels.get(channel)
+        if runs is None:
+            if not 0 <= channel < N_CHANNELS:
+                raise ValueError(f'Channel {channel} is not 0 to {N_CHANNELS - 1}')
+            mask = np.uint16(1 << channel)
+            idx, changed = self.changes()
+            idx = idx[(changed & mask) != 0]
+            initial_level = bool(self.values[0] & mask) if len(self) else False
+            levels = np.ones(len(idx), dtype=bool)
+            levels[0 if initial_level else 1::2] = False
+            runs = self._channels[channel] = ChannelRuns(channel, initial_level, self.starts[idx], levels)
+        return runs
+
+
+    def project(self, channels):
+        """Capture of only the given channels, the others read as zero"""
+        mask = 0
+        for ch in channels:
+            mask |= 1 << ch
+        cap = self._projections.get(mask)
+        if cap is None:
+            values = self.values & np.uint16(mask)
+            first = np.ones(len(values), dtype=bool)
+            first[1:] = values[1:] != values[:-1]
+            cap = Capture(values[first], self.starts[first], self.sample_rate, self.start, self.end, self.trigger_sample)
+            self._projections[mask] = cap
+        return cap
+
+
+def decode_rep_packets(data) -> tuple:
+    """Input states and repeat counts of all repetition packets in uploaded data
+
+    Trailing bytes short of a whole transfer packet are ignored.
+    """
+    n_transfer_packets = len(data) // SIZEOF_TRANSFER_PKT
+    pkts = np.frombuffer(data, TRANSFER_PKT_DTYPE, count=n_transfer_packets)
+    rep = pkts['rep'].reshape(-1)
+    return rep['state'], rep['count']
+
+
+def sequence_errors(data) -> list:
+    """Indexes of the transfer packets whose sequence number doesn't follow the previous one
+
+    The FPGA numbers transfer packets 0, 1, 2... modulo 256, so lost or repeated USB data shows
+    as a break in the sequence.
+    """
+    seq = np.frombuffer(data, TRANSFER_PKT_DTYPE, count=len(data) // SIZEOF_TRANSFER_PKT)['seq']
+    return (np.flatnonzero((seq[1:] - seq[:-1]) != 1) + 1).tolist()
+
+
+def decode(data, sample_rate:float, n_rep_packets_before_trigger:int=0) -> Capture:
+    """Decode uploaded data, merging repetition packets with the same input state into runs"""
+    states, counts = decode_rep_packets(data)
+    ends = np.cumsum(counts, dtype=np.uint64)
+    n_samples = int(ends[-1]) if len(ends) else 0
+    trigger_sample = int(ends[n_rep_packets_before_trigger - 1]) if 0 < n_rep_packets_before_trigger <= len(ends) else 0
+    used = counts != 0 # Unused repetition packets in the last transfer packet have zero count
+    values = states[used]
+    ends = ends[used]
+    first = np.ones(len(values), dtype=bool)
+    first[1:] = values[1:] != values[:-1]
+    starts = np.empty(int(first.sum()), dtype=np.uint64)
+    if len(starts):
+        starts[0] = 0
+        starts[1:] = ends[:-1][first[1:]]
+    return Capture(values[first], starts, sample_rate, 0, n_samples, trigger_sample)
+
+
+def read_capture_file(fname:str, sample_rate:float, n_rep_packets_before_trigger:int=0) -> Capture:
+    """Decode a capture file saved by klarty.capture_data_to_file()"""
+    return decode(np.fromfile(fname, dtype=np.uint8), sample_rate, n_rep_packets_before_trigger)
+
+
+def iter_rep_packets(f, block_transfer_packets:int=1 << 20):
+    """Input states and repeat counts of the repetition packets in an open capture file, a block at a time"""
+    while True:
+        pkts = np.fromfile(f, TRANSFER_PKT_DTYPE, count=block_transfer_packets)
+        if len(pkts) == 0:
+            return
+        rep = pkts['rep'].reshape(-1)
+        yield rep['state'], rep['count']
+
+
+class CaptureWriter:
+    """Writes runs to a file in the uploaded data format, a batch at a time
+
+    Runs are given by their start sample numbers, each run lasting until the next, and the
+    last until the end given to close(). If trigger_sample is given a repetition packet
+    starts there and its index is kept in n_rep_packets_before_trigger, to decode the file with.
+    """
+
+    def __init__(self, f, trigger_sample:int=None):
+        self.f = f
+        self.trigger_sample = trigger_sample
+        self.n_rep_packets = 0
+        self.n_rep_packets_before_trigger = 0
+        self.n_transfer_packets = 0
+        self.n_samples = 0
+        self._value = None # The last run, which lasts until the next write_runs() or close()
+        self._start = 0
+        self._states = np.empty(0, dtype=np.uint16) # Repetition packets short of a whole transfer packet
+        self._counts = np.empty(0, dtype=np.uint8)
+
+
+    def write_runs(self, values, starts):
+        """Add runs, merging consecutive runs of the same value, e.g. after masking channels"""
+        if len(values) == 0:
+            return
+        if self._value is not None:
+            values = np.concatenate(([self._value], values))
+            starts = np.concatenate(([self._start], starts))
+        keep = np.ones(len(values), dtype=bool)
+        keep[:-1] = starts[1:] != starts[:-1] # Empty runs would keep equal neighbours apart
+        values, starts = values[keep], starts[keep]
+        keep = np.ones(len(values), dtype=bool)
+        keep[1:] = values[1:] != values[:-1]
+        values, starts = values[keep], starts[keep]
+        self._write(values[:-1], starts[:-1], starts[1:])
+        self._value, self._start = values[-1], starts[-1]
+
+
+    def close(self, end:int):
+        """Write the last run, ending at sample end, and pad the last transfer packet"""
+        if self._value is not None:
+            self._write(np.array([self._value], dtype=np.uint16), np.array([self._start]), np.array([end]))
+            self._value = None
+        n_pad = -len(self._states) % N_REP_PKTS_PER_TRANSFER_PKT
+        if len(self._states):
+            self._states = np.concatenate((self._states, np.zeros(n_pad, dtype=np.uint16)))
+            self._counts = np.concatenate((self._counts, np.zeros(n_pad, dtype=np.uint8)))
+            self._write_rep_packets(np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.uint8))
+
+
+    def _write(self, values, starts, ends):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        keep = ends > starts
+        values, starts, ends = values[keep], starts[keep], ends[keep]
+        if len(values) == 0:
+            return
+        t = self.trigger_sample
+        split = t is not None and starts[0] <= t < ends[-1]
+        if split:
+            k = int(np.searchsorted(starts, t, side='right')) - 1
+            if starts[k] < t: # Split the run so that a repetition packet starts at the trigger
+                values = np.insert(values, k + 1, values[k])
+                starts = np.insert(starts, k + 1, t)
+                ends = np.insert(ends, k, t)
+                k += 1
+        durations = ends - starts
+        n_pkts = (durations + MAX_REP_COUNT - 1) // MAX_REP_COUNT
+        if split:
+            self.n_rep_packets_before_trigger = self.n_rep_packets + int(n_pkts[:k].sum())
+        last = np.cumsum(n_pkts) - 1
+        states = np.repeat(values, n_pkts)
+        counts = np.full(len(states), MAX_REP_COUNT, dtype=np.uint8)
+        counts[last] = durations - MAX_REP_COUNT * (n_pkts - 1)
+        self.n_rep_packets += len(states)
+        self.n_samples += int(durations.sum())
+        self._write_rep_packets(states, counts)
+
+
+    def _write_rep_packets(self, states, counts):
+        states = np.concatenate((self._states, states))
+        counts = np.concatenate((self._counts, counts))
+        n = len(states) // N_REP_PKTS_PER_TRANSFER_PKT
+        n_whole = n * N_REP_PKTS_PER_TRANSFER_PKT
+        pkts = np.empty(n, dtype=TRANSFER_PKT_DTYPE)
+        pkts['rep']['state'] = states[:n_whole].reshape(n, N_REP_PKTS_PER_TRANSFER_PKT)
+        pkts['rep']['count'] = counts[:n_whole].reshape(n, N_REP_PKTS_PER_TRANSFER_PKT)
+        pkts['seq'] = (self.n_transfer_packets + np.arange(n)) & 0xFF
+        self.f.write(pkts.data)
+        self.n_transfer_packets += n
+        self._states, self._counts = states[n_whole:], counts[n_whole:]
+
+
+def write_capture_file(fname:str, cap:Capture) -> int:
+    """Save a capture in the uploaded data format, returns n_rep_packets_before_trigger to decode it with
+
+    None if the trigger is outside the capture, e.g. a slice before or after it, as the file can't
+    record that: decoding it with 0 puts the trigger at its first sample.
+    """
+    trigger = cap.trigger_sample - cap.start
+    inside = 0 <= trigger < cap.n_samples
+    with open(fname, 'wb') as f:
+        writer = CaptureWriter(f, trigger if inside else None)
+        writer.write_runs(cap.values, np.maximum(cap.starts.astype(np.int64) - cap.start, 0))
+        writer.close(cap.n_samples)
+    return writer.n_rep_packets_before_trigger if inside else None
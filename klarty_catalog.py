@@ -0,0 +1,278 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Catalog of saved captures in an sqlite3 database, so the archive can be searched without
+# opening the capture files.
+#
+# Each capture has a row with the device identity, capture settings and trigger information,
+# and a row per channel with its edge count, level and first/last edge (the active interval).
+# Captures are added when saved by setting klarty.catalog, existing files with 'index'. Saved
+# captures are decoded for the catalog in a background thread, so uploads don't wait for it.
+#
+#   d.catalog = klarty_catalog.Catalog()                   # Record each capture as it is saved
+#   python klarty_catalog.py index --rate 1e5 captures/   # Add capture files saved without a catalog
+#   python klarty_catalog.py find --channel 3 --min-edges 1000
+#
+#   for c in klarty_catalog.Catalog().find(channel=3, min_edges=1000, serial='...'):
+#       print(c.file, c.sample_rate)
+
+import os
+import time
+import queue
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+
+from klarty_format import N_CHANNELS
+
+log = logging.getLogger('klarty.catalog')
+
+DEFAULT_CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'captures', 'catalog.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    file TEXT UNIQUE NOT NULL,
+    saved_at REAL NOT NULL,
+    model TEXT,
+    unit_type TEXT,
+    serial TEXT,
+    sample_rate REAL,
+    n_samples INTEGER,
+    pre_trigger_samples INTEGER,
+    threshold_volts REAL,
+    n_rep_packets INTEGER,
+    n_rep_packets_before_trigger INTEGER,
+    write_pos INTEGER,
+    trigger_sample INTEGER,
+    n_bytes INTEGER,
+    n_runs INTEGER,
+    active_channels INTEGER
+);
+CREATE INDEX IF NOT EXISTS captures_saved_at ON captures(saved_at);
+CREATE INDEX IF NOT EXISTS captures_serial ON captures(serial, saved_at);
+CREATE TABLE IF NOT EXISTS channels (
+    capture_id INTEGER NOT NULL REFERENCES captures(id) ON DELETE CASCADE,
+    channel INTEGER NOT NULL,
+    n_edges INTEGER NOT NULL,
+    n_rising INTEGER NOT NULL,
+    initial_level INTEGER NOT NULL,
+    first_edge INTEGER,
+    last_edge INTEGER,
+    high_samples INTEGER NOT NULL,
+    PRIMARY KEY (capture_id, channel)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS channels_edges ON channels(channel, n_edges);
+'''
+
+CAPTURE_COLUMNS = ["id", "file", "saved_at", "model", "unit_type", "serial", "sample_rate", "n_samples",
+                   "pre_trigger_samples", "threshold_volts", "n_rep_packets", "n_rep_packets_before_trigger",
+                   "write_pos", "trigger_sample", "n_bytes", "n_runs", "active_channels"]
+CatalogEntry = namedtuple("CatalogEntry", CAPTURE_COLUMNS)
+# first_edge, last_edge: sample numbers of the channel's first and last edges, None if it never changed
+ChannelSummary = namedtuple("ChannelSummary", ["channel", "n_edges", "n_rising", "initial_level", "first_edge", "last_edge", "high_samples"])
+
+
+def summarise_channels(cap) -> list:
+    """ChannelSummary of each channel of a Capture"""
+    import numpy as np
+    summaries = []
+    for ch in range(N_CHANNELS):
+        runs = cap.channel(ch)
+        n = len(runs.edges)
+        bounds = np.concatenate(([cap.start], runs.edges.astype(np.int64), [cap.end]))
+        high = np.concatenate(([runs.initial_level], runs.levels))
+        summaries.append(ChannelSummary(ch, n, int(runs.levels.sum()), int(runs.initial_level),
+                                        int(runs.edges[0]) if n else None, int(runs.edges[-1]) if n else None,
+                                        int(np.diff(bounds)[high].sum())))
+    return summaries
+
+
+class Catalog:
+    """The catalog database, safe to share between threads"""
+
+    def __init__(self, path:str=DEFAULT_CATALOG):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL') # Readers don't wait for a capture being added
+        self.db.execute('PRAGMA foreign_keys=ON')
+        self.db.executescript(SCHEMA)
+        self._pending = None # Queue of add_later() files, and its thread, started on first use
+
+
+    def close(self):
+        self.wait()
+        self.db.close()
+
+
+    def add_later(self, fname:str, **metadata):
+        """add() the file in a background thread, find() includes it once recorded, see wait()"""
+        with self.lock:
+            if self._pending is None:
+                self._pending = queue.Queue()
+                threading.Thread(target=self._add_pending, daemon=True).start()
+        self._pending.put((fname, metadata))
+
+
+    def _add_pending(self):
+        while True:
+            fname, metadata = self._pending.get()
+            try:
+                self.add(fname, **metadata)
+            except Exception:
+                log.exception('Failed to add %s to the catalog', fname)
+            finally:
+                self._pending.task_done()
+
+
+    def wait(self):
+        """Wait until the files given to add_later() so far are recorded"""
+        if self._pending is not None:
+            self._pending.join()
+
+
+    def add(self, fname:str, data=None, sample_rate:float=None, n_rep_packets_before_trigger:int=0,
+            saved_at:float=None, **metadata) -> int:
+        """Record a capture file, decoding data (or the file) for the channel summaries
+
+        metadata are other columns of the captures table, see klarty.capture_metadata().
+        Recording a file again replaces its entry. Returns the capture id.
+        """
+        from klarty_capture import decode # Only adding captures needs NumPy, not queries
+        fname = os.path.abspath(fname)
+        if data is None:
+            with open(fname, 'rb') as f:
+                data = f.read()
+        cap = decode(data, sample_rate or 1.0, n_rep_packets_before_trigger or 0)
+        summaries = summarise_channels(cap)
+        row = dict(metadata, file=fname, sample_rate=sample_rate, n_rep_packets_before_trigger=n_rep_packets_before_trigger,
+                   saved_at=saved_at if saved_at is not None else os.path.getmtime(fname),
+                   trigger_sample=cap.trigger_sample, n_bytes=len(data), n_runs=len(cap),
+                   active_channels=sum(1 << s.channel for s in summaries if s.n_edges))
+        if 'n_samples' not in row or row['n_samples'] is None:
+            row['n_samples'] = cap.n_samples
+        unknown = set(row) - set(CAPTURE_COLUMNS)
+        if unknown:
+            raise ValueError(f'Unknown catalog columns {sorted(unknown)}')
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM captures WHERE file = ?', (fname,))
+            cur = self.db.execute(f'INSERT INTO captures ({", ".join(row)}) VALUES ({", ".join("?" * len(row))})',
+                                  tuple(row.values()))
+            capture_id = cur.lastrowid
+            self.db.executemany('INSERT INTO channels VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(capture_id, *s) for s in summaries])
+        return capture_id
+
+
+    def find(self, channel:int=None, min_edges:int=None, max_edges:int=None, model:str=None, serial:str=None,
+             since:float=None, until:float=None, sample_rate:float=None, limit:int=None) -> list:
+        """CatalogEntry of each capture matching all the given conditions, oldest first
+
+        min_edges/max_edges apply to channel, since/until are times as from time.time().
+        """
+        where, params = [], []
+        join = ''
+        if channel is not None:
+            join = 'JOIN channels ch ON ch.capture_id = c.id AND ch.channel = ?'
+            params.append(channel)
+            if min_edges is not None:
+                where.append('ch.n_edges >= ?')
+                params.append(min_edges)
+            if max_edges is not None:
+                where.append('ch.n_edges <= ?')
+                params.append(max_edges)
+        elif min_edges is not None or max_edges is not None:
+            raise ValueError('min_edges and max_edges need a channel')
+        for column, op, value in (('model', '=', model), ('serial', '=', serial), ('saved_at', '>=', since),
+                                  ('saved_at', '<', until), ('sample_rate', '=', sample_rate)):
+            if value is not None:
+                where.append(f'c.{column} {op} ?')
+                params.append(value)
+        sql = f'SELECT c.* FROM captures c {join}'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY c.saved_at'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self.lock:
+            return [CatalogEntry(*row) for row in self.db.execute(sql, params)]
+
+
+    def channels(self, capture_id:int) -> list:
+        """ChannelSummary of each channel of a capture"""
+        with self.lock:
+            rows = self.db.execute('SELECT channel, n_edges, n_rising, initial_level, first_edge, last_edge, high_samples '
+                                   'FROM channels WHERE capture_id = ? ORDER BY channel', (capture_id,)).fetchall()
+        return [ChannelSummary(*row) for row in rows]
+
+
+    def remove_missing(self) -> int:
+        """Remove entries whose capture file no longer exists, returns the number removed"""
+        with self.lock, self.db:
+            ids = [(i,) for i, fname in self.db.execute('SELECT id, file FROM captures') if not os.path.exists(fname)]
+            self.db.executemany('DELETE FROM captures WHERE id = ?', ids)
+        return len(ids)
+
+
+    def index_directory(self, dirname:str, sample_rate:float=None) -> int:
+        """Add the capture files in dirname not already in the catalog, returns the number added"""
+        with self.lock:
+            known = {fname for (fname,) in self.db.execute('SELECT file FROM captures')}
+        n = 0
+        for entry in sorted(os.scandir(dirname), key=lambda e: e.name):
+            fname = os.path.abspath(entry.path)
+            if entry.is_file() and entry.name.endswith('.bin') and fname not in known:
+                self.add(fname, sample_rate=sample_rate)
+                n += 1
+        return n
+
+
+def print_entries(entries:list):
+    for e in entries:
+        channels = ','.join(str(ch) for ch in range(N_CHANNELS) if e.active_channels & (1 << ch))
+        rate = f'{e.sample_rate:g}Hz' if e.sample_rate else '?Hz'
+        print(f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(e.saved_at))} {os.path.basename(e.file)} '
+              f'{e.model or "?"} {rate} {e.n_samples} samples, active channels {channels or "none"}')
+
+if __name__=="__main__":
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] index DIR | find | prune')
+    parser.add_option('-d', '--db',        dest='db',        help='catalog database', default=DEFAULT_CATALOG)
+    parser.add_option('-r', '--rate',      dest='rate',      help='index: sample rate of the files, Hz', type='float')
+    parser.add_option('-c', '--channel',   dest='channel',   help='find: channel for --min-edges/--max-edges', type='int')
+    parser.add_option('-m', '--min-edges', dest='min_edges', help='find: at least this many edges', type='int')
+    parser.add_option('-M', '--max-edges', dest='max_edges', help='find: at most this many edges', type='int')
+    parser.add_option('-s', '--serial',    dest='serial',    help='find: captures by the analyser with this KAuth serial (hex)')
+    parser.add_option('-n', '--limit',     dest='limit',     help='find: at most this many captures', type='int')
+    (options, args) = parser.parse_args()
+    catalog = Catalog(options.db)
+    if args[:1] == ['index'] and len(args) == 2:
+        print(f'Added {catalog.index_directory(args[1], options.rate)} captures')
+    elif args == ['find']:
+        t = time.perf_counter()
+        entries = catalog.find(options.channel, options.min_edges, options.max_edges, serial=options.serial, limit=options.limit)
+        print_entries(entries)
+        print(f'{len(entries)} captures found in {(time.perf_counter() - t) * 1e3:.1f}ms')
+    elif args == ['prune']:
+        print(f'Removed {catalog.remove_missing()} entries')
+    else:
+        parser.error('Need a command: index DIR, find or prune')
+    catalog.close()
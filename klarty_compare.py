@@ -0,0 +1,138 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Comparison of a capture against a known-good (golden) capture of the same board.
+#
+# The captures are aligned on their trigger samples, so both must be decoded with the
+# n_rep_packets_before_trigger of their CaptureInfo. Each channel is compared as the XOR of
+# its two edge lists: every edge of either capture toggles the XOR, coincident edges cancel,
+# and the mismatch intervals are where the XOR is high. Nothing is expanded to samples.
+# Mismatches no longer than the tolerance are ignored, allowing for edges that moved by up to
+# the tolerance (and also hiding glitches that short).
+#
+#   python klarty_compare.py --rate 1e6 --tolerance 2e-6 golden.bin new.bin --ref-trigger 1200 --trigger 1195
+
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from klarty_capture import read_capture_file, N_CHANNELS
+
+# intervals: int64 array of (start, end) sample numbers relative to the trigger, one row per mismatch
+ChannelDiff = namedtuple("ChannelDiff", ["channel", "n_ref_edges", "n_edges", "intervals", "mismatch_samples"])
+# start, end: sample numbers relative to the trigger of the period compared by both captures
+Comparison = namedtuple("Comparison", ["sample_rate", "start", "end", "tolerance_samples", "channels"])
+
+
+def level_at(runs, sample:int) -> bool:
+    """Level of a channel at sample, runs from Capture.channel()"""
+    k = int(np.searchsorted(runs.edges, np.uint64(sample), side='right'))
+    return bool(runs.levels[k - 1]) if k else runs.initial_level
+
+
+def _relative_edges(cap, channel:int, start:int, end:int) -> tuple:
+    """Edges of channel strictly inside (start, end), relative to the trigger, and the level at start"""
+    runs = cap.channel(channel)
+    edges = runs.edges
+    i0 = int(np.searchsorted(edges, np.uint64(start + cap.trigger_sample), side='right'))
+    i1 = int(np.searchsorted(edges, np.uint64(end + cap.trigger_sample), side='left'))
+    return edges[i0:i1].astype(np.int64) - cap.trigger_sample, level_at(runs, start + cap.trigger_sample)
+
+
+def mismatch_intervals(ref_edges, edges, initial_mismatch:bool, start:int, end:int, tolerance_samples:int=0):
+    """Intervals between start and end where two channels differ, from their edge lists
+
+    ref_edges and edges are sorted sample numbers inside (start, end), initial_mismatch is
+    whether the channels differ at start. Returns an int64 array of (start, end) rows.
+    """
+    # Both lists are sorted, so the stable (radix/merge) sort is a linear merge
+    toggles = np.sort(np.concatenate((ref_edges, edges)), kind='stable')
+    same = np.flatnonzero(toggles[1:] == toggles[:-1])
+    if len(same):
+        keep = np.ones(len(toggles), dtype=bool)
+        keep[same] = False # Edges at the same sample in both cancel
+        keep[same + 1] = False
+        toggles = toggles[keep]
+    bounds = np.empty(len(toggles) + 2, dtype=np.int64)
+    bounds[0] = start
+    bounds[1:-1] = toggles
+    bounds[-1] = end
+    first = 0 if initial_mismatch else 1 # Segment i differs when (i & 1) == first
+    intervals = np.stack((bounds[first:-1:2], bounds[first + 1::2]), axis=1)
+    return intervals[(intervals[:, 1] - intervals[:, 0]) > tolerance_samples]
+
+
+def compare(ref, cap, channels=range(N_CHANNELS), tolerance:float=0.0) -> Comparison:
+    """Compare cap against the reference capture ref over the time both cover
+
+    tolerance is in seconds, mismatches no longer than this are ignored.
+    """
+    if ref.sample_rate != cap.sample_rate:
+        raise ValueError(f'Sample rates differ, {ref.sample_rate:g}Hz and {cap.sample_rate:g}Hz')
+    start = max(ref.start - ref.trigger_sample, cap.start - cap.trigger_sample)
+    end = min(ref.end - ref.trigger_sample, cap.end - cap.trigger_sample)
+    if end <= start:
+        raise ValueError('Captures do not overlap when aligned on their triggers')
+    tolerance_samples = int(round(tolerance * ref.sample_rate))
+    diffs = []
+    for ch in channels:
+        ref_edges, ref_level = _relative_edges(ref, ch, start, end)
+        edges, level = _relative_edges(cap, ch, start, end)
+        intervals = mismatch_intervals(ref_edges, edges, ref_level != level, start, end, tolerance_samples)
+        diffs.append(ChannelDiff(ch, len(ref_edges), len(edges), intervals, int((intervals[:, 1] - intervals[:, 0]).sum())))
+    return Comparison(ref.sample_rate, start, end, tolerance_samples, diffs)
+
+
+def passed(comparison:Comparison) -> bool:
+    return all(len(d.intervals) == 0 for d in comparison.channels)
+
+
+def print_comparison(comparison:Comparison, max_intervals:int=5):
+    rate = comparison.sample_rate
+    print(f'Compared {(comparison.end - comparison.start) / rate:.6g}s from {comparison.start / rate:.6g}s '
+          f'to {comparison.end / rate:.6g}s about the trigger, tolerance {comparison.tolerance_samples} samples')
+    for d in comparison.channels:
+        if len(d.intervals) == 0:
+            continue
+        shown = ', '.join(f'{s / rate:.9g}s+{(e - s) / rate:.3g}s' for s, e in d.intervals[:max_intervals])
+        more = f' and {len(d.intervals) - max_intervals} more' if len(d.intervals) > max_intervals else ''
+        print(f'CH{d.channel:<2d} {len(d.intervals)} mismatches, {d.mismatch_samples / rate:.6g}s total, '
+              f'edges {d.n_ref_edges} ref {d.n_edges} new: {shown}{more}')
+    print('PASS' if passed(comparison) else 'FAIL')
+
+
+def main(ref_fname, fname, sample_rate, ref_trigger, trigger, tolerance, channels):
+    ref = read_capture_file(ref_fname, sample_rate, ref_trigger)
+    cap = read_capture_file(fname, sample_rate, trigger)
+    comparison = compare(ref, cap, channels, tolerance)
+    print_comparison(comparison)
+    return 0 if passed(comparison) else 1
+
+if __name__=="__main__":
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] GOLDEN.bin NEW.bin')
+    parser.add_option('-r', '--rate',        dest='rate',        help='sample rate of both captures, Hz', type='float')
+    parser.add_option('-R', '--ref-trigger', dest='ref_trigger', help='n_rep_packets_before_trigger of the golden capture', type='int', default=0)
+    parser.add_option('-t', '--trigger',     dest='trigger',     help='n_rep_packets_before_trigger of the new capture', type='int', default=0)
+    parser.add_option('-T', '--tolerance',   dest='tolerance',   help='ignore mismatches up to this long, seconds', type='float', default=0.0)
+    parser.add_option('-c', '--channels',    dest='channels',    help='comma separated channels to compare, default all')
+    (options, args) = parser.parse_args()
+    if len(args) != 2 or options.rate is None:
+        parser.error('Need --rate and two capture files')
+    channels = [int(c) for c in options.channels.split(',')] if options.channels else range(N_CHANNELS)
+    sys.exit(main(args[0], args[1], options.rate, options.ref_trigger, options.trigger, options.tolerance, channels))
@@ -0,0 +1,212 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Extraction of a time window and/or channels from a capture file, optionally decimated,
+# written as a new capture file. The source is read a block at a time so memory use does not
+# depend on its size.
+#
+# Decimation by N makes each output sample from N input samples. An output sample normally
+# takes the input state at the end of its N samples, which keeps every edge to the nearest
+# output sample. A channel that changed within the N samples but ended where it started
+# (a pulse shorter than an output sample) is inverted for that one output sample, so glitches
+# stay visible rather than vanishing.
+#
+#   python klarty_extract.py -r 200e6 -w 1.25,1.3 -c 0,1 -o 1e6 big.bin small.bin
+#
+#   info = klarty_extract.extract('big.bin', 'small.bin', 200e6, window=(1.25, 1.3), channels=[0, 1], decimate=200)
+#   cap = klarty_capture.read_capture_file('small.bin', info.sample_rate, info.n_rep_packets_before_trigger)
+
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from klarty_capture import Capture, CaptureWriter, iter_rep_packets
+
+DEFAULT_BLOCK_TRANSFER_PACKETS = 1 << 20 # 16MB of the source file at a time
+
+ExtractInfo = namedtuple("ExtractInfo", ["sample_rate", "n_samples", "n_rep_packets", "n_rep_packets_before_trigger", "n_bytes"])
+
+
+class Decimator:
+    """Decimates runs by factor, a batch at a time, keeping pulses shorter than an output sample
+
+    feed() takes runs with start sample numbers relative to the start of the output and
+    returns the output runs finished so far, flush() returns the rest.
+    """
+
+    def __init__(self, factor:int):
+        if factor < 1:
+            raise ValueError(f'Decimation factor {factor} is not 1 or more')
+        self.factor = factor
+        self._last_value = None
+        self._bin = None # Output sample, start value, within-sample changes and end value of the unfinished output sample
+
+
+    def feed(self, values, starts) -> tuple:
+        if len(values) == 0:
+            return values, np.empty(0, dtype=np.int64)
+        starts = np.asarray(starts, dtype=np.int64)
+        if self.factor == 1:
+            return values, starts
+        prev = np.empty_like(values)
+        prev[0] = values[0] if self._last_value is None else self._last_value
+        prev[1:] = values[:-1]
+        self._last_value = values[-1]
+        j = starts // self.factor
+        aligned = starts % self.factor == 0 # A change exactly on an output sample boundary is not a glitch
+        changed = np.where(aligned, 0, values ^ prev).astype(np.uint16)
+
+        first = np.flatnonzero(np.concatenate(([True], j[1:] != j[:-1])))
+        last = np.concatenate((first[1:] - 1, [len(j) - 1]))
+        bins = j[first]
+        start_values = np.where(aligned[first], values[first], prev[first])
+        changes = np.bitwise_or.reduceat(changed, first)
+        end_values = values[last]
+        if self._bin is not None:
+            b, s, c, e = self._bin
+            if b == bins[0]:
+                start_values[0] = s
+                changes[0] |= c
+            else:
+                bins = np.concatenate(([b], bins))
+                start_values = np.concatenate(([s], start_values))
+                changes = np.concatenate(([c], changes))
+                end_values = np.concatenate(([e], end_values))
+        self._bin = (bins[-1], start_values[-1], changes[-1], end_values[-1])
+        return self._output(bins[:-1], start_values[:-1], changes[:-1], end_values[:-1])
+
+
+    def flush(self) -> tuple:
+        if self._bin is None:
+            return np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.int64)
+        b, s, c, e = self._bin
+        self._bin = None
+        return self._output(np.array([b]), np.array([s], dtype=np.uint16), np.array([c], dtype=np.uint16), np.array([e], dtype=np.uint16))
+
+
+    def _output(self, bins, start_values, changes, end_values) -> tuple:
+        glitches = changes & ~(start_values ^ end_values)
+        # Each output sample with changes, followed by its end value from the next output sample
+        values = np.empty(2 * len(bins), dtype=np.uint16)
+        values[0::2] = end_values ^ glitches
+        values[1::2] = end_values
+        starts = np.empty(2 * len(bins), dtype=np.int64)
+        starts[0::2] = bins
+        starts[1::2] = bins + 1
+        keep = np.ones(len(starts), dtype=bool)
+        keep[:-1] = starts[:-1] != starts[1:] # The next output sample's own value wins
+        return values[keep], starts[keep]
+
+
+def decimate(cap:Capture, factor:int) -> Capture:
+    """Decimated copy of an in-memory capture, see Decimator"""
+    decimator = Decimator(factor)
+    starts = np.maximum(cap.starts.astype(np.int64) - cap.start, 0)
+    values, starts = decimator.feed(cap.values, starts)
+    tail_values, tail_starts = decimator.flush()
+    values = np.concatenate((values, tail_values))
+    starts = np.concatenate((starts, tail_starts))
+    first = np.ones(len(values), dtype=bool)
+    first[1:] = values[1:] != values[:-1]
+    return Capture(values[first], starts[first].astype(np.uint64), cap.sample_rate / factor,
+                   0, -(-cap.n_samples // factor), (cap.trigger_sample - cap.start) // factor)
+
+
+def source_trigger_sample(f, n_rep_packets_before_trigger:int, block_transfer_packets:int) -> int:
+    """Sample number of the trigger, summing the repeat counts before it"""
+    total = 0
+    remaining = n_rep_packets_before_trigger
+    for states, counts in iter_rep_packets(f, block_transfer_packets):
+        if remaining <= len(counts):
+            return total + int(counts[:remaining].sum(dtype=np.uint64))
+        total += int(counts.sum(dtype=np.uint64))
+        remaining -= len(counts)
+    return total
+
+
+def extract(src_fname:str, dst_fname:str, sample_rate:float, window=None, channels=None, decimate:int=1,
+            n_rep_packets_before_trigger:int=0, block_transfer_packets:int=DEFAULT_BLOCK_TRANSFER_PACKETS) -> ExtractInfo:
+    """Write the window (t_start, t_end) in seconds from the trigger of src_fname to dst_fname
+
+    Channels not in channels are written as zero. The output sample rate is sample_rate / decimate.
+    """
+    mask = np.uint16(0xFFFF)
+    if channels is not None:
+        mask = np.uint16(sum(1 << ch for ch in channels))
+    with open(src_fname, 'rb') as src:
+        trigger = source_trigger_sample(src, n_rep_packets_before_trigger, block_transfer_packets) if n_rep_packets_before_trigger else 0
+        src.seek(0)
+        s0, s1 = 0, None
+        if window is not None:
+            s0 = max(trigger + int(round(window[0] * sample_rate)), 0)
+            s1 = max(trigger + int(round(window[1] * sample_rate)), s0)
+        out_trigger = (trigger - s0) // decimate if trigger >= s0 and (s1 is None or trigger < s1) else None
+        decimator = Decimator(decimate)
+        with open(dst_fname, 'wb') as dst:
+            writer = CaptureWriter(dst, out_trigger)
+            end = 0
+            for states, counts in iter_rep_packets(src, block_transfer_packets):
+                used = counts != 0
+                states = states[used] & mask
+                ends = end + np.cumsum(counts[used], dtype=np.int64)
+                if len(ends) == 0:
+                    continue
+                starts = ends - counts[used]
+                end = int(ends[-1])
+                i0 = int(np.searchsorted(ends, s0, side='right'))
+                i1 = len(starts) if s1 is None else int(np.searchsorted(starts, s1, side='left'))
+                if i1 > i0:
+                    writer.write_runs(*decimator.feed(states[i0:i1], np.maximum(starts[i0:i1], s0) - s0))
+                if s1 is not None and end >= s1:
+                    break
+            writer.write_runs(*decimator.flush())
+            source_end = end if s1 is None else min(end, s1)
+            n_samples = -(-max(source_end - s0, 0) // decimate)
+            writer.close(n_samples)
+    return ExtractInfo(sample_rate / decimate, n_samples, writer.n_rep_packets,
+                       writer.n_rep_packets_before_trigger if out_trigger is not None else 0, os.path.getsize(dst_fname))
+
+
+def main(src_fname, dst_fname, sample_rate, window, channels, out_rate, trigger):
+    factor = 1
+    if out_rate:
+        factor = int(round(sample_rate / out_rate))
+        if factor < 1 or abs(factor * out_rate - sample_rate) > 1e-6 * sample_rate:
+            raise ValueError(f'Output rate {out_rate:g}Hz is not {sample_rate:g}Hz divided by a whole number')
+    t = time.perf_counter()
+    info = extract(src_fname, dst_fname, sample_rate, window, channels, factor, trigger)
+    t = time.perf_counter() - t
+    print(f'{dst_fname}: {info.n_samples} samples at {info.sample_rate:g}Hz in {info.n_bytes} bytes '
+          f'({os.path.getsize(src_fname)} source bytes in {t:.3f}s)')
+    print(f'n_rep_packets {info.n_rep_packets}, n_rep_packets_before_trigger {info.n_rep_packets_before_trigger}')
+
+if __name__=="__main__":
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] SOURCE.bin DEST.bin')
+    parser.add_option('-r', '--rate',     dest='rate',     help='sample rate of the source capture, Hz', type='float')
+    parser.add_option('-t', '--trigger',  dest='trigger',  help='n_rep_packets_before_trigger of the source capture', type='int', default=0)
+    parser.add_option('-w', '--window',   dest='window',   help='t_start,t_end in seconds from the trigger')
+    parser.add_option('-c', '--channels', dest='channels', help='comma separated channels to keep, default all')
+    parser.add_option('-o', '--out-rate', dest='out_rate', help='decimate to this sample rate, Hz', type='float')
+    (options, args) = parser.parse_args()
+    if len(args) != 2 or options.rate is None:
+        parser.error('Need --rate, a source and a destination capture file')
+    window = tuple(float(t) for t in options.window.split(',')) if options.window else None
+    channels = [int(c) for c in options.channels.split(',')] if options.channels else None
+    main(args[0], args[1], options.rate, window, channels, options.out_rate, options.trigger)
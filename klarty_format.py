@@ -0,0 +1,44 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# The capture data format: how the FPGA packs samples into SDRAM and how they are uploaded.
+#
+# Only the standard library is needed, so the device code (klarty.py) and the analysis
+# modules (klarty_capture.py etc.) can share these without importing each other.
+
+# The FPGA stores samples in the 128MB SDRAM as 'repetition packets', a 16bit input state followed by an
+# 8bit repeat count. Five repetition packets plus an 8bit sequence number make up a 16 byte 'transfer packet',
+# which is the unit that is written to SDRAM and uploaded over USB.
+SAMPLE_MEM_SZ_BYTES = 128 * 1024 * 1024
+SIZEOF_REP_PKT = 2 + 1
+N_REP_PKTS_PER_TRANSFER_PKT = 5
+SIZEOF_TRANSFER_PKT = (SIZEOF_REP_PKT * N_REP_PKTS_PER_TRANSFER_PKT) + 1
+MAX_REP_COUNT = 0xFC # Largest repeat count the FPGA writes, captures of idle inputs roll over at 0xFC not 0xFF
+MAX_REP_PKTS_IN_MEM = (SAMPLE_MEM_SZ_BYTES // SIZEOF_TRANSFER_PKT) * N_REP_PKTS_PER_TRANSFER_PKT
+N_CHANNELS = 16 # One bit of the input state per channel
+
+
+def rep_packets_to_nbytes(n_rep_packets:int) -> int:
+    """Number of SDRAM bytes holding n_rep_packets, rounded up to whole transfer packets"""
+    n_transfer_packets = -(-int(n_rep_packets) // N_REP_PKTS_PER_TRANSFER_PKT)
+    return n_transfer_packets * SIZEOF_TRANSFER_PKT
+
+
+def rep_packet_offset(rep_packet_index:int) -> int:
+    """Byte offset of a repetition packet within uploaded data, skipping the sequence bytes"""
+    n_transfer_packets, n_rep_packets = divmod(int(rep_packet_index), N_REP_PKTS_PER_TRANSFER_PKT)
+    return (n_transfer_packets * SIZEOF_TRANSFER_PKT) + (n_rep_packets * SIZEOF_REP_PKT)
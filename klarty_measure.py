@@ -0,0 +1,106 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Timing measurements on decoded captures (see klarty_capture.py).
+#
+# Everything works on the edge times of each channel, see Capture.channel(), never on
+# individual samples, so the cost depends on the number of edges rather than the capture length.
+# Periods are measured rising edge to rising edge. Duty is the high time following each
+# rising edge over that period. All times are in seconds.
+#
+#   cap = klarty_capture.read_capture_file('captures/2021-01-13T13-15-51.bin', 1e5)
+#   for m in klarty_measure.measure(cap, channels=[0, 1]):
+#       print(m.channel, m.frequency, m.duty)
+
+from collections import namedtuple
+
+import numpy as np
+
+ChannelTiming = namedtuple("ChannelTiming", [
+    "channel", "n_rising", "n_falling",
+    "frequency", "period", "period_min", "period_max", "jitter_rms", "jitter_pp",
+    "duty", "duty_min", "duty_max",
+    "high_min", "high_max", "high_percentiles",
+    "low_min", "low_max", "low_percentiles"])
+
+DEFAULT_PERCENTILES = (1, 50, 99)
+
+
+def _stats(x, percentiles) -> tuple:
+    if len(x) == 0:
+        return np.nan, np.nan, tuple(np.nan for _ in percentiles)
+    return float(x.min()), float(x.max()), tuple(float(p) for p in np.percentile(x, percentiles))
+
+
+def measure_edges(channel:int, edge_samples, levels, sample_rate:float, percentiles=DEFAULT_PERCENTILES) -> ChannelTiming:
+    """Timing statistics from edge sample numbers and the level after each edge, see Capture.channel()"""
+    t = edge_samples.astype(np.float64) / sample_rate
+    n = len(t)
+    widths = np.diff(t)
+    high = widths[levels[:-1]]
+    low = widths[~levels[:-1]]
+
+    rising = t[levels]
+    periods = np.diff(rising)
+    # Whole cycles start at a rising edge followed by a falling and another rising edge
+    i = np.flatnonzero(levels[:max(0, n - 2)])
+    duty = (t[i + 1] - t[i]) / (t[i + 2] - t[i])
+
+    if len(periods):
+        period = (rising[-1] - rising[0]) / len(periods)
+        period_min, period_max = float(periods.min()), float(periods.max())
+        jitter_rms = float(periods.std())
+    else:
+        period = period_min = period_max = jitter_rms = np.nan
+    high_min, high_max, high_percentiles = _stats(high, percentiles)
+    low_min, low_max, low_percentiles = _stats(low, percentiles)
+    return ChannelTiming(channel=channel,
+                         n_rising=len(rising),
+                         n_falling=n - len(rising),
+                         frequency=1.0 / period if period > 0 else np.nan,
+                         period=period,
+                         period_min=period_min,
+                         period_max=period_max,
+                         jitter_rms=jitter_rms,
+                         jitter_pp=period_max - period_min,
+                         duty=float(duty.mean()) if len(duty) else np.nan,
+                         duty_min=float(duty.min()) if len(duty) else np.nan,
+                         duty_max=float(duty.max()) if len(duty) else np.nan,
+                         high_min=high_min,
+                         high_max=high_max,
+                         high_percentiles=high_percentiles,
+                         low_min=low_min,
+                         low_max=low_max,
+                         low_percentiles=low_percentiles)
+
+
+def measure(cap, channels=range(16), window=None, percentiles=DEFAULT_PERCENTILES) -> list:
+    """ChannelTiming for each channel, optionally only over window (t_start, t_end) in seconds from the trigger"""
+    if window is not None:
+        cap = cap.slice(*window)
+    measurements = []
+    for ch in channels:
+        runs = cap.channel(ch)
+        measurements.append(measure_edges(ch, runs.edges, runs.levels, cap.sample_rate, percentiles))
+    return measurements
+
+
+def print_measurements(measurements:list):
+    print(' CH  rising falling     frequency   duty%    jitter_rms     high_min     high_max      low_min      low_max')
+    for m in measurements:
+        print(f'{m.channel:3d} {m.n_rising:7d} {m.n_falling:7d} {m.frequency:12.6g}Hz {100*m.duty:7.3f} '
+              f'{m.jitter_rms:12.4g}s {m.high_min:12.4g} {m.high_max:12.4g} {m.low_min:12.4g} {m.low_max:12.4g}')
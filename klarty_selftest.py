@@ -0,0 +1,178 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Self test using the user PWM outputs looped back to inputs.
+#
+# Wire PWM1 to CH0 and PWM2 to CH1 (or say which channels with --pwm1/--pwm2), then
+#
+#   python klarty_selftest.py          # Analyser with FX2 firmware and FPGA loaded, as klarty-03
+#   python klarty_selftest.py --sim    # Simulated analyser, see klarty_sim.py
+#
+# Timing: the PWMs are set to known frequencies and duties and captured at several sample rates.
+# The measured frequency and duty of each must match the PWM registers to within the
+# resolution of the capture. The PWM and sample clocks come from the same oscillator, so this
+# checks the sample clock divisor and model identity (e.g. an LA1016 taken for an LA2016 would
+# measure double the frequency) rather than oscillator accuracy.
+#
+# Upload: captures of increasing size with a fast PWM, to make plenty of data, are uploaded and
+# checked for transfer packet sequence breaks (lost USB data), the expected number of bytes
+# and the expected number of samples. The upload rate of each is reported.
+#
+# The PWMs are left as configured by the last test.
+
+import sys
+import optparse
+from collections import namedtuple
+
+from klarty import klarty, console_logging
+from klarty_capture import decode, sequence_errors
+from klarty_measure import measure
+
+PWM_CLOCK = 200e6 # As klarty.user_pwm_settings()
+TIMING_TESTS = ((1e3, 25.0, 100e3, 50.0), (10e3, 50.0, 1e6, 20.0)) # PWM1 freq, duty%, PWM2 freq, duty%
+TIMING_SAMPLE_RATES = (10e6, 20e6, 50e6)
+MIN_SAMPLES_PER_PERIOD = 8  # Don't measure PWMs with fewer samples per period
+N_PERIODS = 50              # Capture at least this many periods of each PWM measured
+UPLOAD_PWM = (10e6, 50.0)   # Busy input for upload tests, two repetition packets per 10 samples at 100MHz
+UPLOAD_SAMPLE_RATE = 100e6
+UPLOAD_SAMPLES = (1e5, 1e6, 1e7, 5e7)
+
+TimingCheck = namedtuple("TimingCheck", ["sample_rate", "pwm", "channel", "frequency", "measured_frequency", "error_ppm",
+                                         "tolerance_ppm", "duty", "measured_duty", "duty_tolerance", "passed"])
+UploadCheck = namedtuple("UploadCheck", ["n_samples", "n_bytes", "expected_bytes", "decoded_samples", "sequence_errors",
+                                         "upload_time", "bytes_per_sec", "passed"])
+SelfTestResult = namedtuple("SelfTestResult", ["timing", "upload", "passed"])
+
+
+def pwm_registers(freq:float, duty_percent:float) -> tuple:
+    """Period and duty register values, as klarty.user_pwm_settings() sets them"""
+    period = int((PWM_CLOCK / freq) + 0.5)
+    return period, int((period * duty_percent / 100.0) + 0.5)
+
+
+def capture(d:klarty, sample_rate:float, n_samples:int, timeout:float=20.0) -> tuple:
+    """Capture and upload into memory rather than a file, returns CapturePlan, CaptureInfo and data"""
+    plan = d.arm(sample_rate, n_samples, 0)
+    complete = d.wait_for_capture(timeout)
+    d.stop_acquisition()
+    if not complete:
+        raise TimeoutError(f'Capture not complete after {timeout}sec')
+    ci = d.capture_info(verbose=False)
+    span = d.upload_span(ci.n_rep_packets, ci.write_pos, ci.n_rep_packets_before_trigger)
+    data = d.capture_upload(ci.n_rep_packets, ci.write_pos, ci.n_rep_packets_before_trigger, bytearray(span.n_bytes))
+    return plan, ci, span, data if data is not None else b''
+
+
+def check_timing(d:klarty, pwm_channels:dict, pwm_settings:dict, sample_rate:float) -> list:
+    """Capture the PWMs at sample_rate and check each that has enough samples per period
+
+    pwm_channels maps PWM number to input channel, pwm_settings PWM number to (freq, duty%).
+    """
+    checks = []
+    measurable = {}
+    for pwm, (freq, duty_percent) in pwm_settings.items():
+        period, duty = pwm_registers(freq, duty_percent)
+        if sample_rate * period / PWM_CLOCK >= MIN_SAMPLES_PER_PERIOD:
+            measurable[pwm] = (PWM_CLOCK / period, duty / period)
+    if not measurable:
+        return checks
+    n_samples = int(sample_rate * N_PERIODS / min(f for f, _ in measurable.values()))
+    plan, ci, span, data = capture(d, sample_rate, n_samples)
+    cap = decode(data, plan.sample_rate, ci.n_rep_packets_before_trigger)
+    for pwm, (freq, duty) in sorted(measurable.items()):
+        channel = pwm_channels[pwm]
+        m = measure(cap, [channel])[0]
+        samples_per_period = plan.sample_rate / freq
+        n_periods = max(m.n_rising - 1, 1)
+        # Each edge is to the nearest sample: the mean period to one sample over the capture, the duty to one sample per period
+        tolerance_ppm = 1e6 * 2 / (n_periods * samples_per_period)
+        duty_tolerance = 1.0 / samples_per_period
+        error_ppm = 1e6 * (m.frequency - freq) / freq if m.n_rising > 1 else float('inf')
+        passed = abs(error_ppm) <= tolerance_ppm and abs(m.duty - duty) <= duty_tolerance
+        checks.append(TimingCheck(plan.sample_rate, pwm, channel, freq, m.frequency, error_ppm, tolerance_ppm,
+                                  duty, m.duty, duty_tolerance, passed))
+    return checks
+
+
+def check_upload(d:klarty, n_samples:int, sample_rate:float=UPLOAD_SAMPLE_RATE) -> UploadCheck:
+    """Capture and upload n_samples, checking the data arrived complete and in order"""
+    plan, ci, span, data = capture(d, sample_rate, n_samples)
+    errors = sequence_errors(data)
+    cap = decode(data, plan.sample_rate, ci.n_rep_packets_before_trigger)
+    passed = not errors and len(data) == span.n_bytes and cap.n_samples == plan.n_samples
+    return UploadCheck(plan.n_samples, len(data), span.n_bytes, cap.n_samples, errors,
+                       d.metrics['upload_time'], d.metrics['upload_bytes_per_sec'], passed)
+
+
+def self_test(d:klarty, pwm_channels:dict=None, timing_tests=TIMING_TESTS, sample_rates=TIMING_SAMPLE_RATES,
+              upload_samples=UPLOAD_SAMPLES) -> SelfTestResult:
+    """Run the timing then upload tests on a connected analyser, see the top of this file
+
+    pwm_channels maps PWM number to the input channel it is looped back to, by default {1: 0, 2: 1}.
+    """
+    if pwm_channels is None:
+        pwm_channels = {1: 0, 2: 1}
+    timing = []
+    d.user_pwm_enable(1, 1)
+    for freq1, duty1, freq2, duty2 in timing_tests:
+        d.user_pwm_settings(1, freq1, duty1)
+        d.user_pwm_settings(2, freq2, duty2)
+        settings = {1: (freq1, duty1), 2: (freq2, duty2)}
+        for sample_rate in sample_rates:
+            if sample_rate <= d.fpga_clk:
+                timing.extend(check_timing(d, pwm_channels, settings, sample_rate))
+    upload = []
+    d.user_pwm_settings(1, *UPLOAD_PWM)
+    d.user_pwm_settings(2, *UPLOAD_PWM)
+    for n_samples in upload_samples:
+        upload.append(check_upload(d, n_samples, min(UPLOAD_SAMPLE_RATE, d.fpga_clk)))
+    return SelfTestResult(timing, upload, all(c.passed for c in timing + upload))
+
+
+def print_result(result:SelfTestResult):
+    print('Timing    rate  PWM CH     frequency        measured   error ppm (tol)      duty  measured (tol)')
+    for c in result.timing:
+        print(f'{c.sample_rate / 1e6:8g}MHz  {c.pwm}  {c.channel:2d} {c.frequency:12.6g}Hz {c.measured_frequency:14.9g}Hz '
+              f'{c.error_ppm:9.1f} ({c.tolerance_ppm:6.1f}) {100 * c.duty:8.3f}% {100 * c.measured_duty:8.3f}% '
+              f'({100 * c.duty_tolerance:.2f}) {"ok" if c.passed else "FAIL"}')
+    print('Upload  samples       bytes   expected  seq errors   time       rate')
+    for c in result.upload:
+        print(f'{c.n_samples:14d} {c.n_bytes:11d} {c.expected_bytes:10d} {len(c.sequence_errors):11d} '
+              f'{c.upload_time * 1e3:7.1f}ms {c.bytes_per_sec / 1e6:6.1f}MB/s {"ok" if c.passed else "FAIL"}'
+              + ('' if c.decoded_samples == c.n_samples else f' decoded {c.decoded_samples} samples'))
+    print('PASS' if result.passed else 'FAIL')
+
+if __name__=="__main__":
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--sim',  dest='sim',  help='test a simulated analyser', action='store_true', default=False)
+    parser.add_option('-1', '--pwm1', dest='pwm1', help='input channel wired to PWM1', type='int', default=0)
+    parser.add_option('-2', '--pwm2', dest='pwm2', help='input channel wired to PWM2', type='int', default=1)
+    parser.add_option('-v', '--verbose', dest='verbose', help='log everything klarty does', action='store_true', default=False)
+    (options, args) = parser.parse_args()
+    if options.verbose:
+        console_logging()
+    d = klarty()
+    if options.sim:
+        from klarty_sim import SimDevice
+        d.connect(SimDevice(loopback={options.pwm1: 1, options.pwm2: 2}, upload_bytes_per_sec=d.upload_bytes_per_sec))
+    else:
+        d.connect()
+    d.set_model_identity()
+    result = self_test(d, {1: options.pwm1, 2: options.pwm2})
+    print_result(result)
+    d.disconnect()
+    sys.exit(0 if result.passed else 1)
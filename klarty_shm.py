@@ -0,0 +1,214 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Handing uploaded captures to analysis processes through shared memory.
+#
+# The uploader reads each capture straight from USB into a new SharedMemory segment (see
+# klarty.capture_upload_nbytes(buffer)) and puts a CaptureDescriptor on the queue of each
+# consumer. Consumers attach by name, analyse the data in place and release it. The publisher
+# owns the segments: it counts one reference per consumer it published to and unlinks a
+# segment when all of them have released it, so nothing is copied or written to disk.
+#
+#   publisher = ShmPublisher()                        # In the process which owns the analyser
+#   workers = [multiprocessing.Process(target=worker, args=(q, publisher.release_queue)) for q in queues]
+#   desc = publisher.capture(d, 100e6, 1e8, 10)
+#   publisher.publish(desc, queues)
+#   publisher.collect()                               # Now and then, unlinks released segments
+#
+#   def worker(queue, release_queue):                 # In each analysis process
+#       desc = queue.get()
+#       with SharedCapture(desc, release_queue) as shared:
+#           cap = klarty_capture.decode(shared.data, desc.sample_rate, desc.capture_info.n_rep_packets_before_trigger)
+#
+# Consumers should be started from the publisher process (multiprocessing), so that they share
+# its resource tracker and attaching doesn't make them responsible for unlinking segments.
+# python klarty_shm.py checks the release path with a simulated analyser.
+
+import sys
+import queue
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import namedtuple
+
+log = logging.getLogger('klarty.capture')
+
+# name: shared memory segment, n_bytes: uploaded bytes at its start, metadata: klarty.capture_metadata()
+CaptureDescriptor = namedtuple("CaptureDescriptor", ["name", "n_bytes", "capture_info", "sample_rate", "metadata"])
+
+# Segments released by SharedCapture.close() while views of them were still alive, unmapped by a later close()
+_still_mapped = []
+
+
+class ShmPublisher:
+    def __init__(self, release_queue=None):
+        self.release_queue = release_queue if release_queue is not None else multiprocessing.Queue()
+        self.segments = {} # name: [SharedMemory, references]
+        self.lock = threading.Lock()
+
+
+    def upload(self, d) -> CaptureDescriptor:
+        """Stop the capture started by d.arm() and upload it into a new segment, see klarty.upload()"""
+        d.stop_acquisition()
+        ci = d.capture_info()
+        span = d.upload_span(ci.n_rep_packets, ci.write_pos, ci.n_rep_packets_before_trigger)
+        shm = shared_memory.SharedMemory(create=True, size=max(span.n_bytes, 1))
+        try:
+            data = d.capture_upload(ci.n_rep_packets, ci.write_pos, ci.n_rep_packets_before_trigger, shm.buf)
+            n_bytes = len(data) if data is not None else 0
+            if data is not None:
+                data.release()
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        with self.lock:
+            self.segments[shm.name] = [shm, 0]
+        metadata = d.capture_metadata()
+        log.info('Uploaded %d bytes to shared memory %s', n_bytes, shm.name)
+        return CaptureDescriptor(shm.name, n_bytes, ci, metadata['sample_rate'], metadata)
+
+
+    def capture(self, d, sample_rate, n_samples, capture_ratio_percent, timeout:float=20.0) -> CaptureDescriptor:
+        """Run one capture into a new segment, as klarty.capture()"""
+        d.arm(sample_rate, n_samples, capture_ratio_percent)
+        if not d.wait_for_capture(timeout):
+            d.stop_acquisition()
+            raise TimeoutError(f'Capture not complete after {timeout}sec')
+        return self.upload(d)
+
+
+    def publish(self, desc:CaptureDescriptor, queues:list):
+        """Give the capture to each consumer queue, it is unlinked once they have all released it"""
+        with self.lock:
+            self.segments[desc.name][1] += len(queues)
+        for q in queues:
+            q.put(desc)
+        if not queues:
+            self.release(desc.name, 0)
+
+
+    def release(self, name:str, n:int=1):
+        """Drop n references to a segment, unlinking it at zero"""
+        with self.lock:
+            entry = self.segments.get(name)
+            if entry is None:
+                log.warning('Release of unknown shared memory %s', name)
+                return
+            entry[1] -= n
+            if entry[1] > 0:
+                return
+            del self.segments[name]
+        shm = entry[0]
+        shm.close()
+        shm.unlink()
+        log.debug('Unlinked shared memory %s', name)
+
+
+    def collect(self, timeout:float=None) -> int:
+        """Process releases from consumers, waiting up to timeout for the first. Returns the number processed"""
+        n = 0
+        try:
+            name = self.release_queue.get(timeout=timeout) if timeout else self.release_queue.get_nowait()
+            while True:
+                self.release(name)
+                n += 1
+                name = self.release_queue.get_nowait()
+        except queue.Empty:
+            pass
+        return n
+
+
+    def close(self):
+        """Unlink all segments, whether released or not"""
+        with self.lock:
+            segments, self.segments = self.segments, {}
+        for shm, _ in segments.values():
+            shm.close()
+            shm.unlink()
+
+
+class SharedCapture:
+    """A consumer's view of a published capture, data is a memoryview of the uploaded bytes"""
+
+    def __init__(self, desc:CaptureDescriptor, release_queue):
+        self.desc = desc
+        self.release_queue = release_queue
+        kwargs = {'track': False} if sys.version_info >= (3, 13) else {} # The publisher unlinks
+        self.shm = shared_memory.SharedMemory(name=desc.name, **kwargs)
+        self.data = self.shm.buf[:desc.n_bytes]
+
+
+    def close(self):
+        """Release the capture, views of data (e.g. numpy arrays) must not be used after this
+
+        The release is sent even if such views are still alive. This process then keeps the
+        mapping until a later close() finds them gone, the publisher unlinks the segment anyway.
+        """
+        if self.shm is None:
+            return
+        shm, self.shm = self.shm, None
+        try:
+            self.data.release()
+            shm.close()
+        except BufferError:
+            log.warning('Views of shared memory %s are still alive, keeping it mapped', self.desc.name)
+            _still_mapped.append(shm)
+        finally:
+            self.release_queue.put(self.desc.name)
+        for shm in _still_mapped[:]:
+            try:
+                shm.close()
+            except BufferError:
+                continue
+            _still_mapped.remove(shm)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == "__main__":
+    # Self check with a simulated analyser: a consumer still holding a numpy view of the capture
+    # when it closes must release it all the same, so the publisher unlinks the segment.
+    import numpy as np
+    from klarty import klarty
+    from klarty_sim import SimDevice
+    d = klarty()
+    d.connect(SimDevice(loopback={0: 1}))
+    d.set_model_identity()
+    publisher = ShmPublisher()
+    consumer = multiprocessing.Queue()
+    publisher.publish(publisher.capture(d, 1e6, 1e5, 10), [consumer])
+    with SharedCapture(consumer.get(), publisher.release_queue) as shared:
+        view = np.frombuffer(shared.data, dtype=np.uint8)
+    n_released = publisher.collect(timeout=5.0)
+    try:
+        shared_memory.SharedMemory(name=shared.desc.name).close()
+        unlinked = False
+    except FileNotFoundError:
+        unlinked = True
+    view[0] # Still mapped in this process
+    del view
+    publisher.close()
+    d.disconnect()
+    print(f'Released {n_released} capture(s) with a live view, segment {"unlinked" if unlinked else "LEAKED"}')
+    sys.exit(0 if n_released == 1 and unlinked else 1)
@@ -0,0 +1,215 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Simulated analyser, for running klarty, the daemon and the self test without hardware.
+#
+# SimDevice stands in for the PyUSB device passed to klarty.connect(). It behaves like an
+# analyser with the FX2 firmware and FPGA bitstream already loaded: FPGA register reads and
+# writes over FX2CMD_FPGA_SPI, the EEPROM identity, run state, capture information and bulk
+# upload of the capture from a model of the SDRAM. Firmware loads are accepted and ignored.
+#
+# The inputs are driven by the two user PWM outputs, wired to channels as given by loopback
+# (default PWM1 to CH0, PWM2 to CH1), other channels are low. The PWMs swing pwm_low_volts (0V)
+# to pwm_volts, so a looped back channel only toggles with the threshold (see klarty.threshold())
+# between the two, otherwise it reads high or low. Other levels stand in for an external
+# reference. The simulated threshold is the nominal one with a gain and offset error, for
+# klarty_threshold.py to find. A capture completes as soon as it is started, triggered at its
+# first post-trigger sample.
+#
+#   d = klarty()
+#   d.connect(SimDevice())
+#   d.set_model_identity()
+
+import io
+import time
+import array
+import ctypes
+import struct
+
+import numpy as np
+
+from klarty import (LA_models, VENDOR_CTRL_OUT, FX2CMD_FPGA_SPI_x20_d32, FX2CMD_EEPROM_xA2_d162, FX2CMD_KAUTH_x60_d96,
+                    FX2CMD_START_BULK_TRANSFER_x30_d48, FPGA_REG_RUN, FPGA_REG_UPLOAD, FPGA_REG_SAMPLING,
+                    FPGA_REG_PWM_EN, FPGA_REG_PWM1, FPGA_REG_PWM2, FPGA_REG_THRESHOLD, SAMPLE_MEM_SZ_BYTES,
+                    THRESHOLD_LINES)
+from klarty_capture import CaptureWriter
+
+PWM_CLOCK = 200e6
+UNIT_TYPES = {
+    LA_models.LA1016_R2: bytes([0x09, 0xF6, 0x00, 0x00, 0x09, 0xF6, 0x10, 0xEF]),
+    LA_models.LA2016_R2: bytes([0x08, 0xF7, 0x00, 0x00, 0x08, 0xF7, 0x10, 0xEF]),
+}
+FPGA_CLOCKS = {LA_models.LA1016_R2: 100e6, LA_models.LA2016_R2: 200e6}
+RUN_STATE_DONE = 0x85ED
+
+
+def pwm_edges(period:int, duty:int, samples_per_pwm_clock:float, n_samples:int) -> tuple:
+    """Sample numbers of the rising and falling edges of a PWM output, counting from sample 0"""
+    if period <= 0 or duty <= 0 or duty >= period:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    n_periods = int(n_samples / (period * samples_per_pwm_clock)) + 1
+    rising = np.arange(n_periods, dtype=np.float64) * period
+    # The input is sampled at whole samples, so an edge shows at the first sample at or after it
+    rising_samples = np.ceil(rising * samples_per_pwm_clock).astype(np.int64)
+    falling_samples = np.ceil((rising + duty) * samples_per_pwm_clock).astype(np.int64)
+    return rising_samples[rising_samples < n_samples], falling_samples[falling_samples < n_samples]
+
+
+class SimDevice:
+    def __init__(self, model:LA_models=LA_models.LA2016_R2, loopback:dict=None, upload_bytes_per_sec:float=None,
+                 lose_bytes_above:int=None, serial:bytes=bytes(range(0xA0, 0xA8)), pwm_volts:float=3.3,
+                 pwm_low_volts:float=0.0, threshold_gain:float=1.0, threshold_offset:float=0.0):
+        """loopback maps input channel to PWM output (1 or 2). upload_bytes_per_sec throttles uploads
+        to a realistic rate and lose_bytes_above drops a 512 byte USB packet from larger uploads.
+        The threshold is threshold_gain * nominal threshold + threshold_offset volts."""
+        self.model = model
+        self.fpga_clk = FPGA_CLOCKS[model]
+        self.loopback = loopback if loopback is not None else {0: 1, 1: 2}
+        self.upload_bytes_per_sec = upload_bytes_per_sec
+        self.lose_bytes_above = lose_bytes_above
+        self.serial = serial
+        self.pwm_volts = pwm_volts
+        self.pwm_low_volts = pwm_low_volts
+        self.threshold_gain = threshold_gain
+        self.threshold_offset = threshold_offset
+        self.regs = bytearray(128)
+        self.eeprom = bytearray(256)
+        self.eeprom[0x08:0x10] = UNIT_TYPES[model]
+        self.run_state = RUN_STATE_DONE
+        self.capture_info = (0, 0, 0)
+        self.sdram = b'' # Capture data, written from SDRAM address 0
+        self.upload = None
+        self.kauth_cmd = None
+
+
+    def set_configuration(self):
+        pass
+
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        if bmRequestType == VENDOR_CTRL_OUT:
+            data = bytes(data_or_wLength) if data_or_wLength is not None else b''
+            if bRequest == FX2CMD_FPGA_SPI_x20_d32:
+                self.fpga_write(wValue & 0x7F, data)
+            elif bRequest == FX2CMD_START_BULK_TRANSFER_x30_d48:
+                start_pos, n_bytes = struct.unpack_from('<LL', self.regs, FPGA_REG_UPLOAD)
+                self.upload = (start_pos, n_bytes)
+            elif bRequest == FX2CMD_KAUTH_x60_d96:
+                self.kauth_cmd = data
+            elif bRequest == FX2CMD_EEPROM_xA2_d162:
+                self.eeprom[wValue:wValue + len(data)] = data
+            return len(data)
+        n = data_or_wLength
+        if bRequest == FX2CMD_FPGA_SPI_x20_d32:
+            return self.fpga_read(wValue & 0x7F, n)
+        if bRequest == FX2CMD_EEPROM_xA2_d162:
+            return bytes(self.eeprom[wValue:wValue + n])
+        if bRequest == FX2CMD_KAUTH_x60_d96:
+            return (bytes([0xA3, len(self.serial)]) + self.serial).ljust(n, b'\0')[:n]
+        return bytes(n)
+
+
+    def write(self, endpoint, data, timeout=None):
+        return len(data) # FPGA bitstream
+
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        if self.upload is None:
+            raise IOError('Bulk read without FX2CMD_START_BULK_TRANSFER')
+        start_pos, n_bytes = self.upload
+        self.upload = None
+        buffer = size_or_buffer if not isinstance(size_or_buffer, int) else None
+        n = min(n_bytes, buffer.buffer_info()[1] * buffer.itemsize if buffer is not None else size_or_buffer)
+        data = self.sdram_read(start_pos, n)
+        if self.lose_bytes_above is not None and n > self.lose_bytes_above:
+            mid = (n // 2) & ~511
+            data = data[:mid] + data[mid + 512:]
+        if self.upload_bytes_per_sec:
+            time.sleep(len(data) / self.upload_bytes_per_sec)
+        if buffer is None:
+            return array.array('B', data)
+        address, _ = buffer.buffer_info() # As the PyUSB backends do
+        ctypes.memmove(address, data, len(data))
+        return len(data)
+
+
+    def sdram_read(self, start_pos:int, n:int) -> bytes:
+        offset = start_pos % SAMPLE_MEM_SZ_BYTES
+        data = self.sdram[offset:offset + n]
+        return data + bytes(n - len(data))
+
+
+    def fpga_write(self, address:int, data:bytes):
+        self.regs[address:address + len(data)] = data
+        if address <= FPGA_REG_RUN < address + len(data) and data[FPGA_REG_RUN - address] == 0x03:
+            self.run_capture()
+
+
+    def fpga_read(self, address:int, n:int) -> bytes:
+        regs = bytearray(self.regs)
+        struct.pack_into('<H', regs, FPGA_REG_RUN, self.run_state)
+        struct.pack_into('<LLL', regs, FPGA_REG_SAMPLING, *self.capture_info)
+        return bytes(regs[address:address + n])
+
+
+    def threshold_volts(self) -> float:
+        duty_R56, duty_R79 = struct.unpack_from('<HH', self.regs, FPGA_REG_THRESHOLD)
+        slope, offset = THRESHOLD_LINES.get(duty_R79, THRESHOLD_LINES[0x00F2])
+        return self.threshold_gain * (duty_R56 - offset) / slope + self.threshold_offset
+
+
+    def sample_config(self) -> tuple:
+        n_samples, _, pre_trigger_samples, _, divisor, _ = struct.unpack_from('<LBLLHB', self.regs, FPGA_REG_SAMPLING)
+        return n_samples, pre_trigger_samples, max(divisor, 1)
+
+
+    def input_states(self, n_samples:int, divisor:int) -> tuple:
+        """Runs of the input states for n_samples at fpga_clk / divisor, as (values, starts)"""
+        samples_per_pwm_clock = self.fpga_clk / (divisor * PWM_CLOCK)
+        enabled = self.regs[FPGA_REG_PWM_EN]
+        threshold = self.threshold_volts()
+        edges, bits = [np.zeros(1, dtype=np.int64)], [np.zeros(1, dtype=np.uint16)]
+        for channel, pwm in self.loopback.items():
+            if threshold <= self.pwm_low_volts: # High whatever the PWM does
+                edges.append(np.zeros(1, dtype=np.int64))
+                bits.append(np.full(1, 1 << channel, dtype=np.uint16))
+            if not enabled & pwm or not self.pwm_low_volts < threshold < self.pwm_volts:
+                continue
+            period, duty = struct.unpack_from('<LL', self.regs, FPGA_REG_PWM1 if pwm == 1 else FPGA_REG_PWM2)
+            for e in pwm_edges(period, duty, samples_per_pwm_clock, n_samples):
+                edges.append(e)
+                bits.append(np.full(len(e), 1 << channel, dtype=np.uint16))
+        edges = np.concatenate(edges)
+        bits = np.concatenate(bits)
+        order = np.argsort(edges, kind='stable')
+        edges, bits = edges[order], bits[order]
+        # Every edge toggles its channel, edges at the same sample combine
+        values = np.bitwise_xor.accumulate(bits)
+        last = np.concatenate((edges[1:] != edges[:-1], [True]))
+        return values[last], edges[last]
+
+
+    def run_capture(self):
+        n_samples, pre_trigger_samples, divisor = self.sample_config()
+        values, starts = self.input_states(n_samples, divisor)
+        f = io.BytesIO()
+        writer = CaptureWriter(f, pre_trigger_samples)
+        writer.write_runs(values, starts)
+        writer.close(n_samples)
+        self.sdram = f.getvalue()
+        self.capture_info = (writer.n_rep_packets, writer.n_rep_packets_before_trigger, len(self.sdram) % SAMPLE_MEM_SZ_BYTES)
+        self.run_state = RUN_STATE_DONE
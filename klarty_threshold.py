@@ -0,0 +1,294 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Threshold calibration: measures the R56 duty which sets each threshold on one analyser, instead
+# of the nominal lines in klarty.THRESHOLD_LINES fitted to the OEM software's settings.
+#
+# A square wave of known low and high voltage (by default PWM1 looped back to CH0, measure its
+# levels with a meter) is captured at different threshold duties. With the threshold below the
+# low level the input always reads high, above the high level always low, and in between it
+# toggles. Reading high / toggling / low only ever goes one way as the R56 duty increases, so
+# each level is found by bisecting the duty for each R79 setting, one short capture per step
+# (about a dozen per level, 3mV resolution). Each level found is a (duty, volts) point on that
+# R79 setting's line. A line is only fitted, and used instead of the nominal one, once it has
+# points at two voltages within its range: about 1.2 to 4.8V for R79 0x0000, -0.4 to 3.2V for
+# 0x00F2 and -3.6 to 0V for 0x02D7. A 0 to 3.3V reference gives each line one point at most, so
+# the reference is stepped, calibrating once per pair of levels and adding to the points so far:
+#
+#   python klarty_threshold.py --low 0 --high 3.28                  # PWM1, calibrate and save
+#   python klarty_threshold.py --add -e 0 --low 1.65 --high 3.3     # Signal generator on CH0
+#   python klarty_threshold.py --add -e 0 --low -2 --high -1
+#   python klarty_threshold.py --sim                                # Check with a simulated analyser
+#
+# Calibrations are saved by analyser (model and KAuth serial) and later applied without any
+# captures. The reference PWM is left running.
+#
+#   d.set_model_identity()
+#   klarty_threshold.apply_calibration(d)               # Saved lines, if this analyser has any
+#   d.threshold(1.65)
+
+import os
+import json
+import time
+import threading
+from collections import namedtuple, Counter
+
+from klarty import klarty, console_logging, THRESHOLD_LINES, THRESHOLD_DUTY_R56_MIN, THRESHOLD_DUTY_R56_MAX
+from klarty_capture import decode
+from klarty_selftest import capture
+
+DEFAULT_CALIBRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+REFERENCE_PWM = (100e3, 50.0)  # freq, duty% of the PWM reference
+SAMPLE_RATE = 10e6
+N_SAMPLES = 2000               # 20 periods of the reference
+MIN_EDGES = 2                  # An input with fewer edges reads steady
+SETTLE_TIME = 0.005            # For the threshold DAC after changing duty, seconds
+MAX_SLOPE_ERROR = 0.2          # Fitted lines may differ this much from the nominal slope
+DEFAULT_THRESHOLD = 1.65       # Volts, set after calibrating if no threshold was set before, as klarty-02
+SIM_REFERENCES = ((0.0, 3.3), (1.65, 3.3), (-2.0, -1.0)) # Reference levels for --sim, two points on every line
+SIM_CHECK_VOLTS = (1.65, 3.3, -1.0) # One threshold on each line, checked after --sim
+MAX_SIM_ERROR = 0.01           # Volts
+
+_save_lock = threading.Lock()  # klartyd calibrates its analysers concurrently
+
+# duty_R79: R79 setting, duty_R56: R56 duty at which the input reference voltage is the threshold
+ThresholdPoint = namedtuple("ThresholdPoint", ["duty_R79", "duty_R56", "volts"])
+# lines: R79 duty: (slope, offset) as klarty.THRESHOLD_LINES for the lines fitted, points: ThresholdPoints they were fitted to
+ThresholdCalibration = namedtuple("ThresholdCalibration", ["key", "lines", "points", "n_captures", "duration", "calibrated_at"])
+
+
+def device_key(d:klarty) -> str:
+    """Name of an analyser in the saved calibrations, reading its KAuth serial if not yet read"""
+    if d.serial is None:
+        d.kauth_read_serial()
+    return f'{d.model.name}-{d.serial.hex()}'
+
+
+def input_levels(d:klarty, channels, duty_R56:int, duty_R79:int) -> list:
+    """'high', 'toggling' or 'low' for each channel, from a short capture with the given threshold duties"""
+    d.threshold_duties(duty_R56, duty_R79)
+    time.sleep(SETTLE_TIME)
+    plan, ci, span, data = capture(d, SAMPLE_RATE, N_SAMPLES)
+    cap = decode(data, plan.sample_rate, ci.n_rep_packets_before_trigger)
+    levels = []
+    for ch in channels:
+        runs = cap.channel(ch)
+        if len(runs.edges) >= MIN_EDGES:
+            levels.append('toggling')
+        else:
+            levels.append('high' if (runs.levels[-1] if len(runs.levels) else runs.initial_level) else 'low')
+    return levels
+
+
+class Sweep:
+    """Input levels at each threshold duty of one R79 setting, each duty captured at most once
+
+    rank() is 0 for reading high, 1 toggling and 2 low, for most of the channels.
+    """
+    RANKS = {'high': 0, 'toggling': 1, 'low': 2}
+
+    def __init__(self, d:klarty, channels, duty_R79:int):
+        self.d = d
+        self.channels = channels
+        self.duty_R79 = duty_R79
+        self.ranks = {}
+
+    def rank(self, duty_R56:int) -> int:
+        if duty_R56 not in self.ranks:
+            levels = input_levels(self.d, self.channels, duty_R56, self.duty_R79)
+            self.ranks[duty_R56] = self.RANKS[Counter(levels).most_common(1)[0][0]]
+        return self.ranks[duty_R56]
+
+    def transition(self, rank:int, lo:int=THRESHOLD_DUTY_R56_MIN, hi:int=THRESHOLD_DUTY_R56_MAX) -> float:
+        """R56 duty at which the rank reaches rank, None if not between lo and hi"""
+        if self.rank(lo) >= rank or self.rank(hi) < rank:
+            return None
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.rank(mid) >= rank:
+                hi = mid
+            else:
+                lo = mid
+        return (lo + hi) / 2
+
+
+def fit_line(points:list, nominal:tuple) -> tuple:
+    """(slope, offset) through points, None with fewer than two distinct voltages"""
+    volts = [p.volts for p in points]
+    if len(set(volts)) < 2:
+        return None
+    n = len(points)
+    mean_v = sum(volts) / n
+    mean_d = sum(p.duty_R56 for p in points) / n
+    slope = (sum((p.volts - mean_v) * (p.duty_R56 - mean_d) for p in points) /
+             sum((v - mean_v) ** 2 for v in volts))
+    if abs(slope / nominal[0] - 1) > MAX_SLOPE_ERROR:
+        raise ValueError(f'R79 duty 0x{points[0].duty_R79:04X}: fitted slope {slope:.1f} is far from nominal '
+                         f'{nominal[0]}, check the reference voltages')
+    return slope, mean_d - slope * mean_v
+
+
+def saved_points(d:klarty, path:str=DEFAULT_CALIBRATIONS) -> list:
+    """ThresholdPoints of the analyser's saved calibration, to add to with calibrate()"""
+    cal = load_calibrations(path).get(device_key(d))
+    return cal.points if cal is not None else []
+
+
+def calibrate(d:klarty, low:float=0.0, high:float=3.3, pwm_channels:dict=None, path:str=DEFAULT_CALIBRATIONS,
+              points:list=()) -> ThresholdCalibration:
+    """Calibrate the threshold of a connected analyser against a reference swinging low to high volts
+
+    pwm_channels maps PWM number to the input channel it is looped back to, to use the PWMs as
+    the reference, by default {1: 0}. With an external reference connected instead, pass {None: channel}.
+    points are ThresholdPoints found with other reference levels (see saved_points()), the lines
+    are fitted to these and the new points. Only lines with points at two voltages are fitted.
+    The fitted lines are used by d.threshold() at once, including for the threshold already set
+    (DEFAULT_THRESHOLD if none was), and saved to path with the points unless path is None.
+    """
+    if not low < high:
+        raise ValueError(f'Reference low {low}V is not below high {high}V')
+    if pwm_channels is None:
+        pwm_channels = {1: 0}
+    t = time.perf_counter()
+    volts = d.threshold_volts if d.threshold_volts is not None else DEFAULT_THRESHOLD
+    pwms = [pwm for pwm in pwm_channels if pwm is not None]
+    if pwms:
+        for pwm in pwms:
+            d.user_pwm_settings(pwm, *REFERENCE_PWM)
+        d.user_pwm_enable(1 in pwms, 2 in pwms)
+    channels = list(pwm_channels.values())
+    points = [p for p in points if p.volts not in (low, high)] # Found again now
+    n_captures = 0
+    try:
+        for duty_R79 in THRESHOLD_LINES:
+            sweep = Sweep(d, channels, duty_R79)
+            for rank, level in ((1, low), (2, high)):
+                duty_R56 = sweep.transition(rank)
+                if duty_R56 is not None:
+                    points.append(ThresholdPoint(duty_R79, duty_R56, level))
+            n_captures += len(sweep.ranks)
+        lines = {}
+        for duty_R79, nominal in THRESHOLD_LINES.items():
+            line = fit_line([p for p in points if p.duty_R79 == duty_R79], nominal)
+            if line is not None:
+                lines[duty_R79] = line
+    finally:
+        d.threshold(volts) # Not the duties of the last sweep step, even if calibrating failed
+    duration = time.perf_counter() - t
+    cal = ThresholdCalibration(device_key(d), lines, points, n_captures, duration, time.time())
+    use_calibration(d, cal)
+    if path is not None:
+        save_calibration(cal, path)
+    return cal
+
+
+def use_calibration(d:klarty, cal:ThresholdCalibration):
+    d.threshold_lines = {**THRESHOLD_LINES, **cal.lines} # Nominal lines where not fitted
+    if d.threshold_volts is not None:
+        d.threshold(d.threshold_volts)
+
+
+def load_calibrations(path:str=DEFAULT_CALIBRATIONS) -> dict:
+    """All saved calibrations by device_key(), an empty dict if there are none"""
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {key: ThresholdCalibration(key, {int(r79): tuple(line) for r79, line in c['lines'].items()},
+                                      [ThresholdPoint(*p) for p in c['points']], c['n_captures'], c['duration'],
+                                      c['calibrated_at'])
+            for key, c in saved.items()}
+
+
+def save_calibration(cal:ThresholdCalibration, path:str=DEFAULT_CALIBRATIONS):
+    """Add or replace one analyser's calibration in the file at path"""
+    with _save_lock:
+        saved = {key: c._asdict() for key, c in load_calibrations(path).items()}
+        saved[cal.key] = cal._asdict()
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(saved, f, indent=1)
+        os.replace(tmp, path) # Readers never see a partly written file
+
+
+def apply_calibration(d:klarty, path:str=DEFAULT_CALIBRATIONS) -> ThresholdCalibration:
+    """Use the saved calibration of a connected analyser, returns it or None if it has none"""
+    calibrations = load_calibrations(path)
+    if not calibrations:
+        return None # Don't spend time reading the serial
+    cal = calibrations.get(device_key(d))
+    if cal is not None:
+        use_calibration(d, cal)
+    return cal
+
+
+def print_calibration(cal:ThresholdCalibration):
+    print(f'{cal.key}: {cal.n_captures} captures in {cal.duration:.2f}s')
+    for p in cal.points:
+        print(f'  R79 0x{p.duty_R79:04X}: {p.volts:6.3f}V at R56 duty {p.duty_R56:7.1f}')
+    for duty_R79, (nominal_slope, nominal_offset) in THRESHOLD_LINES.items():
+        if duty_R79 not in cal.lines:
+            print(f'  R79 0x{duty_R79:04X}: nominal, needs points at two reference voltages')
+            continue
+        slope, offset = cal.lines[duty_R79]
+        print(f'  R79 0x{duty_R79:04X}: R56 duty = {slope:6.1f} * volts {offset:+7.1f}   '
+              f'(nominal {nominal_slope} * volts {nominal_offset:+d})')
+
+if __name__=="__main__":
+    import sys
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--sim',  dest='sim',  help='calibrate a simulated analyser with SIM_REFERENCES and check it', action='store_true', default=False)
+    parser.add_option('-l', '--low',  dest='low',  help='reference low level, volts', type='float', default=0.0)
+    parser.add_option('-H', '--high', dest='high', help='reference high level, volts', type='float', default=3.3)
+    parser.add_option('-a', '--add',  dest='add',  help='add to the saved points of this analyser from other reference levels', action='store_true', default=False)
+    parser.add_option('-1', '--pwm1', dest='pwm1', help='input channel wired to PWM1', type='int', default=0)
+    parser.add_option('-e', '--external', dest='external', help='input channel wired to an external reference instead of PWM1', type='int')
+    parser.add_option('-f', '--file', dest='file', help='saved calibrations', default=DEFAULT_CALIBRATIONS)
+    parser.add_option('-v', '--verbose', dest='verbose', help='log everything klarty does', action='store_true', default=False)
+    (options, args) = parser.parse_args()
+    if options.verbose:
+        console_logging()
+    d = klarty()
+    if options.sim:
+        # The simulated PWM1 swings between each pair of reference levels in turn, then the threshold
+        # error left on each line is checked
+        from klarty_sim import SimDevice
+        sim = SimDevice(loopback={options.pwm1: 1}, threshold_gain=1.03, threshold_offset=-0.05)
+        d.connect(sim)
+        d.set_model_identity()
+        points = []
+        for low, high in SIM_REFERENCES:
+            sim.pwm_low_volts, sim.pwm_volts = low, high
+            cal = calibrate(d, low, high, {1: options.pwm1}, None, points)
+            points = cal.points
+        print_calibration(cal)
+        errors = []
+        for volts in SIM_CHECK_VOLTS:
+            d.threshold(volts)
+            errors.append(sim.threshold_volts() - volts)
+            print(f'  Threshold {volts:5.2f}V: error {1e3 * errors[-1]:+5.1f}mV')
+        d.disconnect()
+        sys.exit(0 if len(cal.lines) == len(THRESHOLD_LINES) and all(abs(e) <= MAX_SIM_ERROR for e in errors) else 1)
+    d.connect()
+    d.set_model_identity()
+    cal = calibrate(d, options.low, options.high,
+                    {None: options.external} if options.external is not None else {1: options.pwm1}, options.file,
+                    saved_points(d, options.file) if options.add else [])
+    print_calibration(cal)
+    d.disconnect()
@@ -0,0 +1,208 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# USB transaction tracing for klarty.
+#
+# Usage:
+#   trace = d.enable_trace()     # d is a connected klarty
+#   ...capture as normal...
+#   trace.print_records()
+#   trace.save_chrome_trace('upload.json')   # Open in chrome://tracing or https://ui.perfetto.dev
+#
+# When tracing is not enabled klarty talks to the PyUSB device directly, so there is no cost.
+# When enabled, each ctrl_transfer/write/read appends one tuple to a fixed size ring buffer.
+# Decoding of FX2CMD_ and FPGA_REG_ names is only done when the records are printed or saved.
+
+import json, time
+from collections import namedtuple
+
+import klarty as _klarty
+
+UsbRecord = namedtuple("UsbRecord", ["op", "t_start_ns", "t_end_ns", "bmRequestType", "bRequest",
+                                     "wValue", "wIndex", "n_bytes", "data", "error"])
+
+MAX_RECORDED_DATA = 64 # Control transfer payloads are kept, bulk payloads are not
+
+FX2CMD_NAMES = {v: k for k, v in vars(_klarty).items() if k.startswith('FX2CMD_')}
+FX2CMD_NAMES[0xA0] = 'FX2_FIRMWARE_LOAD_xA0_d160'
+FPGA_REG_NAMES = sorted((v, k) for k, v in vars(_klarty).items() if k.startswith('FPGA_REG_'))
+ENDPOINT_NAMES = {0x02: 'EP2 FPGA bitstream', 0x86: 'EP86 capture upload'}
+
+
+def fpga_reg_name(address:int) -> str:
+    """Name of the FPGA register at address, as FPGA_REG_xxx or FPGA_REG_xxx+offset"""
+    name = None
+    for reg_address, reg_name in FPGA_REG_NAMES:
+        if reg_address == address:
+            return reg_name
+        if reg_address < address:
+            name = f'{reg_name}+{address - reg_address}'
+    return name if name else f'0x{address:02X}'
+
+
+def describe(rec:UsbRecord) -> str:
+    """Decode the meaning of a recorded USB transaction"""
+    if rec.op != 'ctrl':
+        return f"{rec.op} {ENDPOINT_NAMES.get(rec.bRequest, f'EP{rec.bRequest:02X}')}"
+    direction = 'IN' if rec.bmRequestType & 0x80 else 'OUT'
+    cmd = FX2CMD_NAMES.get(rec.bRequest, f'0x{rec.bRequest:02X}')
+    if rec.bRequest == _klarty.FX2CMD_FPGA_SPI_x20_d32:
+        reg = fpga_reg_name(rec.wValue & 0x7F)
+        return f"{'read' if rec.wValue & 0x80 else 'write'} {reg}"
+    if rec.bRequest == _klarty.FX2CMD_EEPROM_xA2_d162:
+        return f'{direction} {cmd} address=0x{rec.wValue:02X}'
+    if rec.bRequest == 0xA0:
+        if rec.wValue == 0xE600:
+            fx2_reset = rec.data == bytes([1])
+            return f"{cmd} {'FX2 RESET' if fx2_reset else 'FX2 RUN'}"
+        return f'{cmd} offset=0x{rec.wValue:04X}'
+    return f'{direction} {cmd}'
+
+
+class UsbTrace:
+    """Ring buffer of the most recent USB transactions"""
+
+    def __init__(self, n_records:int=65536):
+        self._records = [None] * n_records
+        self._n = 0
+        self.t0_ns = time.perf_counter_ns()
+
+
+    def __len__(self):
+        return min(self._n, len(self._records))
+
+
+    def clear(self):
+        self._records = [None] * len(self._records)
+        self._n = 0
+        self.t0_ns = time.perf_counter_ns()
+
+
+    def append(self, rec:tuple):
+        self._records[self._n % len(self._records)] = rec
+        self._n += 1
+
+
+    def records(self):
+        """Recorded transactions, oldest first"""
+        n_slots = len(self._records)
+        if self._n <= n_slots:
+            recs = self._records[:self._n]
+        else:
+            i = self._n % n_slots
+            recs = self._records[i:] + self._records[:i]
+        return [UsbRecord(*r) for r in recs]
+
+
+    def print_records(self):
+        for rec in self.records():
+            t_ms = (rec.t_start_ns - self.t0_ns) / 1e6
+            dur_us = (rec.t_end_ns - rec.t_start_ns) / 1e3
+            data = '' if rec.data is None else ' ' + ''.join('{:02X} '.format(b) for b in rec.data)
+            error = f' **{rec.error}**' if rec.error else ''
+            print(f'{t_ms:12.3f}ms {dur_us:10.1f}us {rec.n_bytes:9d}B  {describe(rec)}{data}{error}')
+
+
+    def chrome_trace(self) -> dict:
+        """Records as Chrome trace event format, control transfers and each endpoint on their own track"""
+        events = []
+        for rec in self.records():
+            args = {'n_bytes': rec.n_bytes}
+            if rec.op == 'ctrl':
+                args.update(bmRequestType=f'0x{rec.bmRequestType:02X}', bRequest=f'0x{rec.bRequest:02X}',
+                            wValue=f'0x{rec.wValue:04X}', wIndex=rec.wIndex)
+            if rec.data is not None:
+                args['data'] = rec.data.hex(' ').upper()
+            if rec.error:
+                args['error'] = rec.error
+            events.append({'name': describe(rec), 'cat': rec.op, 'ph': 'X', 'pid': 0,
+                           'tid': 0 if rec.op == 'ctrl' else rec.bRequest,
+                           'ts': (rec.t_start_ns - self.t0_ns) / 1e3,
+                           'dur': (rec.t_end_ns - rec.t_start_ns) / 1e3,
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+    def save_chrome_trace(self, filename:str):
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class TracedDevice:
+    """Stands in for a PyUSB device, recording each transaction into a UsbTrace
+
+    Endpoint transfers are recorded with the endpoint number in the bRequest field.
+    """
+
+    def __init__(self, dev, trace:UsbTrace):
+        self.dev = dev
+        self.trace = trace
+
+
+    def __getattr__(self, name):
+        return getattr(self.dev, name)
+
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        error = None
+        resp = None
+        t_start = time.perf_counter_ns()
+        try:
+            resp = self.dev.ctrl_transfer(bmRequestType, bRequest, wValue, wIndex, data_or_wLength, timeout)
+            return resp
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            t_end = time.perf_counter_ns()
+            data = resp if bmRequestType & 0x80 else data_or_wLength
+            if data is None or isinstance(data, int):
+                n_bytes = 0 if data is None else data
+                data = None
+            else:
+                n_bytes = len(data)
+                data = bytes(data[:MAX_RECORDED_DATA])
+            self.trace.append(('ctrl', t_start, t_end, bmRequestType, bRequest, wValue, wIndex, n_bytes, data, error))
+
+
+    def write(self, endpoint, data, timeout=None):
+        error = None
+        n_bytes = 0
+        t_start = time.perf_counter_ns()
+        try:
+            n_bytes = self.dev.write(endpoint, data, timeout)
+            return n_bytes
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            self.trace.append(('write', t_start, time.perf_counter_ns(), 0, endpoint, 0, 0, n_bytes, None, error))
+
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        error = None
+        n_bytes = 0
+        t_start = time.perf_counter_ns()
+        try:
+            resp = self.dev.read(endpoint, size_or_buffer, timeout)
+            n_bytes = resp if isinstance(resp, int) else len(resp)
+            return resp
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            self.trace.append(('read', t_start, time.perf_counter_ns(), 0, endpoint, 0, 0, n_bytes, None, error))
@@ -0,0 +1,89 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Command line client for klartyd.py, the capture daemon.
+#
+# Only the standard library socket and json modules are imported, so the client starts in
+# milliseconds. Arguments are a command followed by name=value parameters, e.g.
+#
+#   python klartyctl.py status
+#   python klartyctl.py capture sample_rate=1e5 n_samples=5e5 pre_trigger_percent=40
+#   python klartyctl.py threshold volts=1.65
+#   python klartyctl.py pwm channel=1 freq=1e3 duty=50
+#   python klartyctl.py capture device=1 sample_rate=2e6 n_samples=1e6
+#   python klartyctl.py --timeout=90 capture sample_rate=1e3 n_samples=5e4 timeout=60
+#
+# --socket= and --timeout= (seconds to wait for the response) are for the client, name=value
+# parameters all go to the daemon. The response is printed as JSON and the exit status is non-zero if the command failed.
+# See klartyd.py for the available commands.
+
+import os, sys, json, socket
+
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'klartyd.sock')
+
+
+def request(cmd:str, params:dict=None, *, socket_path:str=DEFAULT_SOCKET, timeout:float=None) -> dict:
+    """Send one command with its parameters to the daemon and return its response
+
+    timeout is how long the client waits, in seconds, not a parameter of the command.
+    """
+    req = {**(params or {}), 'cmd': cmd}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(socket_path)
+        s.sendall(json.dumps(req).encode() + b'\n')
+        with s.makefile('rb') as f:
+            resp = f.readline()
+    if not resp:
+        raise ConnectionError('No response from klartyd')
+    return json.loads(resp)
+
+
+def parse_value(value:str):
+    """Parameter values are JSON where possible (numbers, true/false), otherwise strings"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def main(argv):
+    socket_path = DEFAULT_SOCKET
+    timeout = None
+    args = argv[1:]
+    while args and args[0].startswith('--'):
+        option, _, value = args.pop(0).partition('=')
+        if option == '--socket':
+            socket_path = value
+        elif option == '--timeout':
+            timeout = float(value)
+        else:
+            args = []
+            break
+    if not args or args[0] in ('-h', '--help'):
+        print(f'Usage: {argv[0]} [--socket=PATH] [--timeout=SECONDS] COMMAND [name=value ...]')
+        return 2
+    params = {}
+    for arg in args[1:]:
+        name, _, value = arg.partition('=')
+        params[name] = parse_value(value)
+    resp = request(args[0], params, socket_path=socket_path, timeout=timeout)
+    print(json.dumps(resp, indent=2))
+    return 0 if resp.get('ok') else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,470 @@
+'''
+Copyright (C) 2021 Kevin Grant <planet911@gmx.com>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Capture daemon: owns the connected analysers and serves requests on a Unix socket.
+#
+# Running klarty-01/02/03 for every capture re-imports PyUSB, finds the device, reads the
+# EEPROM identity and tears everything down again. The daemon does the 01/02 steps once
+# and keeps the FX2 and FPGA configured, so each capture request only costs the capture.
+#
+#   python klartyd.py --fx2 kingst-la-01a2.fw --fpga &      # Load firmware and serve
+#   python klartyd.py &                                     # Analysers already configured
+#   python klartyctl.py capture sample_rate=1e5 n_samples=5e5 pre_trigger_percent=40
+#
+# Protocol: one JSON object per line in each direction. Requests have a 'cmd' and optional
+# 'device' index (default 0) plus the command parameters. Responses have 'ok' and either
+# the command results or 'error'. Commands, see the cmd_ methods below:
+#   ping, devices, status, plan, arm, upload, capture, threshold, calibrate_threshold, pwm,
+#   pwm_enable, trace_start, trace_save, find, shutdown
+#
+# Requests for different analysers run concurrently, requests for the same analyser are queued,
+# so a rack is calibrated by sending calibrate_threshold to every device at once, once for each
+# reference (add=true after the first, see klarty_threshold.py). Saved threshold calibrations are
+# applied to each analyser at startup.
+# With --catalog every capture is recorded in the capture catalog (klarty_catalog.py) as it is
+# saved, and 'find' searches it.
+#
+# With --http the capture commands (HTTP_COMMANDS) are served over HTTP, plus the saved captures.
+# There is no authentication, so bind to localhost and reach it from other machines through ssh:
+#
+#   python klartyd.py --http 127.0.0.1:8016 &
+#   ssh -N -L 8016:127.0.0.1:8016 rack1 &                          # On the remote client
+#   curl 'http://localhost:8016/api/arm?sample_rate=1e6&n_samples=1e8&pre_trigger_percent=10'
+#   curl 'http://localhost:8016/api/status'
+#   curl 'http://localhost:8016/api/upload'                        # Once run_state_name is COMPLETE
+#   curl 'http://localhost:8016/captures/'                         # JSON list of saved captures
+#   curl -O 'http://localhost:8016/captures/2021-01-13T13-15-51.bin'
+#   curl -r 0-1599 'http://localhost:8016/captures/2021-01-13T13-15-51.bin'  # First 100 transfer packets
+#   curl -o now.bin 'http://localhost:8016/capture?sample_rate=1e5&n_samples=5e5'  # Capture and download
+#
+# /api/CMD takes the parameters as a query string or a JSON POST body. Capture files are sent
+# straight from the page cache with socket.sendfile(), with single byte range requests.
+# trace_save writes NAME.json in the traces directory beside the captures.
+
+import os, sys, json, time, socket, signal, logging, optparse, threading, socketserver, http.server, urllib.parse
+from enum import Enum
+
+from klarty import klarty, LA_models, find_devices, console_logging, RUN_STATE_NAMES, RUN_STATE_COMPLETE
+from klartyctl import DEFAULT_SOCKET, parse_value
+
+log = logging.getLogger('klarty.daemon')
+
+# Bitstreams loaded by --fpga, as klarty-02-load-fpga.py
+BITSTREAMS = {
+    LA_models.LA1016_R2: 'kingst-LA1016-WinV3.4.3-tested.bitstream',
+    LA_models.LA2016_R2: 'kingst-LA2016-WinV3.4.3-tested.bitstream',
+}
+FX2_RENUMERATE_TIME = 3.0 # Seconds for the FX2 to reappear on USB after a firmware load
+CAPTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'captures') # As klarty.capture_data_to_file()
+TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces')
+DEFAULT_HTTP_PORT = 8016
+# Commands served over HTTP, the others change settings, write files or stop the daemon
+HTTP_COMMANDS = ('ping', 'devices', 'status', 'plan', 'arm', 'upload', 'capture', 'find')
+
+
+def jsonable(obj):
+    """Convert klarty results (namedtuples, enums, bytes) for json.dumps"""
+    if hasattr(obj, '_asdict'):
+        return {k: jsonable(v) for k, v in obj._asdict().items()}
+    if isinstance(obj, dict):
+        return {k: jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [jsonable(v) for v in obj]
+    if isinstance(obj, Enum):
+        return obj.name
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.hex()
+    return obj
+
+
+class CaptureDaemon:
+    def __init__(self, fx2_fw:str=None, load_fpga:bool=False, catalog=None):
+        self.fx2_fw = fx2_fw
+        self.load_fpga = load_fpga
+        self.catalog = catalog
+        self.devices = []
+        self.locks = []
+        self.server = None
+
+
+    def start(self):
+        """Find and configure all connected analysers"""
+        if self.fx2_fw:
+            for dev in find_devices():
+                d = klarty()
+                d.connect(dev)
+                d.load_fx2_fw(self.fx2_fw)
+                d.disconnect()
+            time.sleep(FX2_RENUMERATE_TIME)
+        import klarty_threshold
+        for dev in find_devices():
+            d = klarty()
+            d.connect(dev)
+            d.set_model_identity()
+            d.catalog = self.catalog
+            if self.load_fpga:
+                self.configure_fpga(d)
+            klarty_threshold.apply_calibration(d) # Saved threshold calibration of this analyser, if any, see klarty_threshold.py
+            self.devices.append(d)
+            self.locks.append(threading.Lock())
+        if not self.devices:
+            raise ValueError('Device not found')
+        log.info('Serving %d analyser(s)', len(self.devices))
+
+
+    def configure_fpga(self, d:klarty):
+        """Load the bitstream and set defaults, as klarty-02-load-fpga.py"""
+        d.load_fpga_fw(BITSTREAMS[d.model])
+        d.get_run_state()
+        d.threshold(1.65)
+        d.user_pwm_enable(0,0)
+        d.user_pwm_settings(1, 1e3, 50)
+        d.user_pwm_settings(2, 100e3, 50)
+        d.user_pwm_enable(1,1)
+
+
+    def stop(self):
+        for d in self.devices:
+            d.disconnect()
+        self.devices = []
+        if self.catalog is not None:
+            self.catalog.close() # After recording the captures still being added
+
+
+    def request(self, req:dict) -> dict:
+        """handle() with exceptions turned into error responses"""
+        try:
+            return self.handle(dict(req))
+        except Exception as e:
+            log.exception('Request failed: %s', req)
+            return {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+
+
+    def handle(self, req:dict) -> dict:
+        cmd = req.pop('cmd', None)
+        method = getattr(self, f'cmd_{cmd}', None)
+        if method is None:
+            return {'ok': False, 'error': f'Unknown command {cmd!r}'}
+        i = int(req.pop('device', 0))
+        if cmd in ('ping', 'devices', 'find', 'shutdown'): # Not for one analyser, any device is ignored
+            return {'ok': True, **jsonable(method(**req))}
+        if i < 0 or i >= len(self.devices):
+            return {'ok': False, 'error': f'No device {i}'}
+        with self.locks[i]:
+            return {'ok': True, **jsonable(method(self.devices[i], **req))}
+
+
+    def cmd_ping(self):
+        return {'pid': os.getpid()}
+
+
+    def cmd_devices(self):
+        return {'devices': [{'model': d.model, 'fpga_clk': d.fpga_clk} for d in self.devices]}
+
+
+    def cmd_status(self, d:klarty):
+        run_state = d.get_run_state()
+        return {'model': d.model, 'run_state': run_state, 'run_state_name': RUN_STATE_NAMES.get(run_state & 0x000F, 'Unknown'),
+                'metrics': d.metrics}
+
+
+    def cmd_plan(self, d:klarty, sample_rate, n_samples, pre_trigger_percent=0):
+        return {'plan': d.plan_capture(sample_rate, n_samples, pre_trigger_percent)}
+
+
+    def cmd_arm(self, d:klarty, sample_rate, n_samples, pre_trigger_percent=0):
+        return {'plan': d.arm(sample_rate, n_samples, pre_trigger_percent)}
+
+
+    def cmd_upload(self, d:klarty):
+        run_state = d.get_run_state()
+        if (run_state & 0x000F) != RUN_STATE_COMPLETE:
+            raise ValueError(f'Capture not complete, run state is {RUN_STATE_NAMES.get(run_state & 0x000F, hex(run_state))}')
+        ci = d.upload()
+        return {'capture_info': ci, 'capture_file': d.metrics.get('capture_file'), 'metrics': d.metrics}
+
+
+    def cmd_capture(self, d:klarty, sample_rate, n_samples, pre_trigger_percent=0, timeout=20.0):
+        ci = d.capture(sample_rate, n_samples, pre_trigger_percent, timeout)
+        return {'capture_info': ci, 'capture_file': d.metrics.get('capture_file'), 'metrics': d.metrics}
+
+
+    def cmd_threshold(self, d:klarty, volts):
+        d.threshold(volts)
+        return {}
+
+
+    def cmd_calibrate_threshold(self, d:klarty, low=0.0, high=3.3, pwm1_channel=0, external_channel=None, add=False):
+        from klarty_threshold import calibrate, saved_points
+        reference = {None: external_channel} if external_channel is not None else {1: pwm1_channel}
+        return {'calibration': calibrate(d, low, high, reference, points=saved_points(d) if add else [])}
+
+
+    def cmd_pwm(self, d:klarty, channel, freq, duty):
+        d.user_pwm_settings(channel, freq, duty)
+        return {}
+
+
+    def cmd_pwm_enable(self, d:klarty, channel1, channel2):
+        d.user_pwm_enable(channel1, channel2)
+        return {}
+
+
+    def cmd_trace_start(self, d:klarty, n_records=65536):
+        d.disable_trace()
+        d.enable_trace(n_records)
+        return {}
+
+
+    def cmd_trace_save(self, d:klarty, name):
+        if d.trace is None:
+            raise ValueError('Tracing has not been started')
+        if not name or name != os.path.basename(name) or name.startswith('.'):
+            raise ValueError(f'Bad trace name {name!r}, a file name without a directory')
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        filename = os.path.join(TRACE_DIR, f'{name}.json')
+        d.trace.save_chrome_trace(filename)
+        return {'n_records': len(d.trace), 'trace_file': filename}
+
+
+    def cmd_find(self, **query):
+        if self.catalog is None:
+            raise ValueError('No catalog, start klartyd with --catalog')
+        return {'captures': self.catalog.find(**query)}
+
+
+    def cmd_shutdown(self):
+        # serve_forever() is in the main thread, this is a request handler thread
+        threading.Thread(target=self.server.shutdown).start()
+        return {}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+            except ValueError as e:
+                resp = {'ok': False, 'error': f'Bad request: {e}'}
+            else:
+                resp = self.server.capture_daemon.request(req)
+            self.wfile.write(json.dumps(resp).encode() + b'\n')
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def list_captures(capture_dir:str=CAPTURE_DIR) -> list:
+    if not os.path.isdir(capture_dir):
+        return []
+    captures = []
+    for entry in sorted(os.scandir(capture_dir), key=lambda e: e.name):
+        if entry.is_file() and entry.name.endswith('.bin'):
+            st = entry.stat()
+            captures.append({'name': entry.name, 'size': st.st_size, 'mtime': st.st_mtime})
+    return captures
+
+
+def parse_range(header:str, size:int):
+    """(start, end) of a single 'bytes=first-last' Range header, end exclusive
+
+    Returns None for ranges this server doesn't do (other units, several ranges), so the
+    whole file is sent, and raises ValueError if the range is outside the file.
+    """
+    units, _, spec = header.partition('=')
+    if units.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if first == '':
+            start, end = max(size - int(last), 0), size # Suffix range, the last n bytes
+        else:
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+    except ValueError:
+        return None
+    if start >= end:
+        raise ValueError(f'Range {header} not satisfiable for {size} bytes')
+    return start, end
+
+
+class HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'klartyd'
+
+    def log_message(self, format, *args):
+        log.info('%s %s', self.address_string(), format % args)
+
+
+    def send_json(self, resp:dict, status:int=200):
+        body = json.dumps(resp).encode() + b'\n'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+    def send_api_response(self, req:dict):
+        if req['cmd'] not in HTTP_COMMANDS:
+            return self.send_json({'ok': False, 'error': f"Command {req['cmd']!r} is only served on the Unix socket"}, 403)
+        resp = self.server.capture_daemon.request(req)
+        self.send_json(resp, 200 if resp['ok'] else 400)
+
+
+    def send_capture_file(self, name:str, extra_headers:dict=None):
+        if name != os.path.basename(name) or not name.endswith('.bin'):
+            return self.send_json({'ok': False, 'error': f'Bad capture name {name!r}'}, 400)
+        try:
+            f = open(os.path.join(CAPTURE_DIR, name), 'rb')
+        except FileNotFoundError:
+            return self.send_json({'ok': False, 'error': f'No capture {name!r}'}, 404)
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size
+            byte_range = None
+            if self.headers.get('Range'):
+                try:
+                    byte_range = parse_range(self.headers['Range'], size)
+                except ValueError as e:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+            if byte_range:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Last-Modified', self.date_time_string(int(os.fstat(f.fileno()).st_mtime)))
+            for k, v in (extra_headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            if self.command != 'HEAD' and end > start:
+                self.connection.sendfile(f, start, end - start)
+
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        params = {k: parse_value(v) for k, v in urllib.parse.parse_qsl(url.query)}
+        if path.startswith('/api/') and self.command == 'GET':
+            self.send_api_response({**params, 'cmd': path[len('/api/'):]})
+        elif path.rstrip('/') == '/captures':
+            self.send_json({'ok': True, 'captures': list_captures()})
+        elif path.startswith('/captures/'):
+            self.send_capture_file(path[len('/captures/'):])
+        elif path == '/capture' and self.command == 'GET':
+            # Capture, then send the file just written, which is still in the page cache
+            resp = self.server.capture_daemon.request({**params, 'cmd': 'capture'})
+            if not resp['ok']:
+                return self.send_json(resp, 400)
+            self.send_capture_file(os.path.basename(resp['capture_file']),
+                                   {'X-Klarty-Capture-Info': json.dumps(resp['capture_info'])})
+        else:
+            self.send_json({'ok': False, 'error': f'Not found: {path}'}, 404)
+
+    do_HEAD = do_GET
+
+
+    def do_POST(self):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not path.startswith('/api/'):
+            return self.send_json({'ok': False, 'error': f'Not found: {path}'}, 404)
+        try:
+            params = json.loads(body) if body else {}
+        except ValueError as e:
+            return self.send_json({'ok': False, 'error': f'Bad request: {e}'}, 400)
+        self.send_api_response({**params, 'cmd': path[len('/api/'):]})
+
+
+class DaemonHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def parse_http_address(address:str) -> tuple:
+    """'[HOST:]PORT' to (host, port), the host defaults to localhost only"""
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port or DEFAULT_HTTP_PORT)
+
+
+def socket_in_use(socket_path:str) -> bool:
+    """Whether something accepts connections on socket_path, rather than it being left by a crashed run"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def serve(daemon:CaptureDaemon, socket_path:str=DEFAULT_SOCKET, http_address:tuple=None):
+    if os.path.exists(socket_path):
+        if socket_in_use(socket_path):
+            raise ValueError(f'{socket_path} is in use, is klartyd already running?')
+        os.remove(socket_path) # Stale socket from a previous run
+    http_server = None
+    with DaemonServer(socket_path, RequestHandler) as server:
+        server.capture_daemon = daemon
+        daemon.server = server
+        os.chmod(socket_path, 0o660)
+        log.info('Listening on %s', socket_path)
+        if http_address:
+            http_server = DaemonHTTPServer(http_address, HTTPRequestHandler)
+            http_server.capture_daemon = daemon
+            threading.Thread(target=http_server.serve_forever, daemon=True).start()
+            log.info('Serving HTTP on %s:%d', *http_server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if http_server:
+                http_server.shutdown()
+                http_server.server_close()
+            daemon.stop()
+            os.remove(socket_path)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--socket', dest='socket', help='Unix socket path', default=DEFAULT_SOCKET)
+    parser.add_option('-x', '--fx2',    dest='fx2',    help='load this FX2 firmware file first')
+    parser.add_option('-f', '--fpga',   dest='fpga',   help='load the FPGA bitstream for each model', action='store_true', default=False)
+    parser.add_option('-c', '--catalog', dest='catalog', help='record captures in this catalog database, see klarty_catalog.py')
+    parser.add_option('-H', '--http',   dest='http',   help=f'also serve HTTP on [HOST:]PORT, e.g. 127.0.0.1:{DEFAULT_HTTP_PORT}')
+    parser.add_option('-v', '--verbose', dest='verbose', help='log everything klarty does', action='store_true', default=False)
+    (options, args) = parser.parse_args()
+    console_logging(logging.INFO if options.verbose else logging.WARNING)
+    log.setLevel(logging.INFO)
+    if socket_in_use(options.socket):
+        parser.error(f'{options.socket} is in use, is klartyd already running?') # Before claiming its analysers
+    catalog = None
+    if options.catalog:
+        from klarty_catalog import Catalog
+        catalog = Catalog(options.catalog)
+    daemon = CaptureDaemon(options.fx2, options.fpga, catalog)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    daemon.start()
+    serve(daemon, options.socket, parse_http_address(options.http) if options.http else None)